@@ -0,0 +1,55 @@
+# coding=utf-8
+"""cold start time of the fctrl cli
+
+runs fctrl --help and fctrl --local list -t (no daemon, the config is read directly) as fresh interpreters and
+reports the best of several runs against the budget. exits with 1 if a command is over budget.
+
+usage: python bench/cold_start.py [config] (default /etc/fctrl/.config)"""
+import os
+import subprocess
+import sys
+from time import perf_counter
+
+FCTRL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fctrl")
+BUDGET = 0.1
+RUNS = 7
+
+# only points FanControl at the config when a command loads it, --help must not import fctrl
+BOOTSTRAP = """import sys
+sys.path.insert(0, {fctrl!r})
+config, sys.argv = sys.argv[1], ["fctrl"] + sys.argv[2:]
+if "list" in sys.argv:
+    import fctrl
+    fctrl.FanControl.config_path = config
+import runpy
+runpy.run_path({cmd!r}, run_name="__main__")
+"""
+
+
+def measure(args, config):
+    """returns best wall time in seconds of fctrl args"""
+    code = BOOTSTRAP.format(fctrl=FCTRL, cmd=os.path.join(FCTRL, "cmd.py"))
+    best = None
+    for _ in range(RUNS):
+        start = perf_counter()
+        result = subprocess.run([sys.executable, "-W", "ignore", "-c", code, config] + args,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed = perf_counter() - start
+        if result.returncode != 0:
+            raise RuntimeError("fctrl {} failed: {}".format(" ".join(args), result.stderr.strip()))
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(config):
+    over = False
+    for args in (["--help"], ["--local", "list", "-t"]):
+        elapsed = measure(args, config)
+        over = over or elapsed > BUDGET
+        print("fctrl {:<16} {:>6.0f} ms (budget {:.0f} ms){}".format(
+            " ".join(args), elapsed * 1000, BUDGET * 1000, "  OVER BUDGET" if elapsed > BUDGET else ""))
+    return 1 if over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1] if len(sys.argv) > 1 else "/etc/fctrl/.config"))
@@ -0,0 +1,54 @@
+# coding=utf-8
+"""per tick cost of the zone filter chains over the number of zones
+
+runs a simulated hwmon tree with N sensors, one ThermalZone each, and times sampling plus the temperature of
+every zone per tick with and without a hampel + ema + kalman chain. the filter cost per zone has to stay flat
+as the zone count grows.
+
+usage: python bench/filters.py [zone counts...]"""
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fctrl"))
+
+from filters import FilterChain
+from simulator import HwmonSimulator
+
+CHAIN = [{"type": "hampel", "window": 5}, {"type": "ema", "alpha": 0.5}, {"type": "kalman"}]
+TICKS = 200
+
+
+def measure(count, filters):
+    """returns mean seconds per tick for count zones"""
+    chips = [{"name": "bench", "sensors": [{"power": 5 + i % 20} for i in range(count)]}]
+    with HwmonSimulator(chips, speed=1000) as sim:
+        from fctrl import FanControl
+        from hwmon import get_all_hwmons
+        control = FanControl({"cooling": {"devices": []}, "thermal": {"zones": []}})
+        zones = get_all_hwmons(control)[0].thermal_zones
+        for zone in zones:
+            zone.filters = FilterChain(CHAIN) if filters else None
+        control.thermal_manager.thermal_zones = zones
+
+        elapsed = 0
+        for _ in range(TICKS):
+            sim.clock.sleep(1)
+            start = perf_counter()
+            control.sampler.sample()
+            for zone in zones:
+                zone.get_temp()
+            elapsed += perf_counter() - start
+        return elapsed / TICKS
+
+
+def main(counts):
+    print("{:>6} {:>12} {:>12} {:>16}".format("zones", "raw µs/tick", "µs/tick", "filter µs/zone"))
+    for count in counts:
+        raw, filtered = measure(count, False), measure(count, True)
+        print("{:>6} {:>12.1f} {:>12.1f} {:>16.2f}".format(count, raw * 1e6, filtered * 1e6,
+                                                          (filtered - raw) / count * 1e6))
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [1, 10, 100, 500])
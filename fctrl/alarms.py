@@ -0,0 +1,217 @@
+# coding=utf-8
+"""event driven wakeups on hwmon temperature alarms"""
+import os
+import select
+import threading
+from time import monotonic
+from file_ops import read_all, write
+
+ALARM_SUFFIXES = ("_max_alarm", "_crit_alarm", "_alarm")
+LIMIT_SUFFIXES = (("_max", "desired"), ("_crit", "critical"))
+# hwmon names of chips whose driver notifies alarm changes (lm90 family through hwmon_notify_event)
+NOTIFY_CHIPS = ("lm90", "lm86", "lm89", "lm99", "adm1032", "adt7461", "adt7461a", "g781", "max6646", "max6657",
+                "max6659", "max6680", "max6695", "max6696", "nct1008", "sa56004", "tmp451", "tmp461")
+
+
+class AlarmWatcher:
+    """programs tempN_max/tempN_crit of every zone from its desired/critical thresholds and blocks in poll on the
+    tempN_*_alarm attributes, calling wake(paths) as soon as an alarm changes
+
+    alarms of chips in notify_chips (their drivers call sysfs_notify) wake the poll immediately, only the alarms
+    of all other chips are re-read every fallback_interval seconds. with notifying chips only the watcher blocks
+    without timeout. zones without alarm attributes (e.g. composites) are left to the regular ticks. as engine
+    listener the watcher re-arms once zones or thresholds changed (e.g. by a config reload). the original limits
+    are restored by stop."""
+
+    def __init__(self, thermal_manager, wake, fallback_interval=0.5, program_limits=True, notify_chips=None):
+        self.thermal_manager = thermal_manager
+        self.wake = wake
+        self.fallback_interval = fallback_interval
+        self.program_limits = program_limits
+        self.notify_chips = set(notify_chips if notify_chips is not None else NOTIFY_CHIPS)
+        self.events = 0
+        self.alarms = {}
+        self.__fds = {}
+        self.__paths = {}
+        self.__polled = []
+        self.__next_poll = 0
+        self.__zones = []
+        self.__layout = None
+        self.__originals = {}
+        self.__programmed = {}
+        self.__poll = None
+        self.__thread = None
+        self.__wakeup = None
+        self.__stopped = threading.Event()
+
+    @staticmethod
+    def get_alarm_paths(zone):
+        """returns existing alarm attributes of zone"""
+        if not zone.base_path:
+            return []
+        return [zone.base_path + suffix for suffix in ALARM_SUFFIXES if os.path.exists(zone.base_path + suffix)]
+
+    def program(self, zone):
+        """writes desired and critical of zone to its limit attributes, keeps the original values for restore"""
+        self.__programmed[zone] = (zone.desired, zone.critical)
+        if not self.program_limits or not zone.base_path:
+            return
+        for suffix, threshold in LIMIT_SUFFIXES:
+            path = zone.base_path + suffix
+            original = read_all(path)
+            if original is None:
+                continue
+            self.__originals.setdefault(path, original.strip())
+            try:
+                write(path, int(getattr(zone, threshold) * 1000))
+            except PermissionError:
+                pass
+
+    def restore(self):
+        """writes back the original limits"""
+        for path, value in self.__originals.items():
+            try:
+                write(path, value)
+            except PermissionError:
+                pass
+        self.__originals = {}
+
+    def get_layout(self):
+        """returns zones with their thresholds, the watcher re-arms when it changes"""
+        return [(zone, zone.desired, zone.critical) for zone in self.thermal_manager.thermal_zones]
+
+    def open(self):
+        """programs all zones and registers their alarm attributes, returns number of watched attributes"""
+        self.__poll = select.poll()
+        if self.__wakeup is not None:
+            self.__poll.register(self.__wakeup[0], select.POLLIN)
+        self.__zones = list(self.thermal_manager.thermal_zones)
+        for zone in self.__zones:
+            paths = self.get_alarm_paths(zone)
+            if not paths:
+                continue
+            self.program(zone)
+            notify = zone.hwmon_name in self.notify_chips
+            for path in paths:
+                try:
+                    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+                except OSError:
+                    continue
+                self.__fds[path] = fd
+                self.__paths[fd] = path
+                # sysfs_notify only wakes pollers that read the attribute before
+                self.alarms[path] = self.__read(fd)
+                if notify:
+                    self.__poll.register(fd, select.POLLPRI | select.POLLERR)
+                else:
+                    self.__polled.append(path)
+        self.__next_poll = monotonic() + self.fallback_interval
+        return len(self.__fds)
+
+    def close(self):
+        for fd in self.__fds.values():
+            os.close(fd)
+        self.__fds = {}
+        self.__paths = {}
+        self.__polled = []
+        self.alarms = {}
+
+    @staticmethod
+    def __read(fd):
+        try:
+            return int(os.pread(fd, 16, 0))
+        except (OSError, ValueError):
+            return None
+
+    def check(self):
+        """blocks until an alarm attribute is notified, the polled attributes are due or the watcher is signalled,
+        returns changed alarm paths"""
+        timeout = None
+        if self.__polled:
+            timeout = max(self.__next_poll - monotonic(), 0) * 1000
+        paths = []
+        for fd, _ in self.__poll.poll(timeout):
+            if fd in self.__paths:
+                paths.append(self.__paths[fd])
+            elif self.__wakeup is not None and fd == self.__wakeup[0]:
+                os.read(fd, 512)
+        if self.__polled and monotonic() >= self.__next_poll:
+            paths.extend(path for path in self.__polled if path not in paths)
+            self.__next_poll = monotonic() + self.fallback_interval
+
+        changed = []
+        for path in paths:
+            value = self.__read(self.__fds[path])
+            if value != self.alarms[path]:
+                self.alarms[path] = value
+                changed.append(path)
+        return changed
+
+    def reprogram(self):
+        """programs zones whose thresholds changed since they were programmed"""
+        for zone in list(self.__programmed):
+            if self.__programmed[zone] != (zone.desired, zone.critical):
+                self.program(zone)
+
+    def reopen(self):
+        """registers the current zones again, restores the limits of zones no longer watched"""
+        self.close()
+        self.restore()
+        self.__programmed = {}
+        self.open()
+
+    def run(self):
+        while not self.__stopped.is_set():
+            changed = self.check()
+            if self.__zones != self.thermal_manager.thermal_zones:
+                self.reopen()
+            else:
+                self.reprogram()
+            if changed:
+                self.events += 1
+                self.wake(changed)
+
+    def signal(self):
+        """wakes the watcher thread, it re-arms and re-reads its alarms"""
+        if self.__wakeup is not None:
+            os.write(self.__wakeup[1], b"\0")
+
+    def __call__(self, engine, snapshot):
+        layout = self.get_layout()
+        if layout == self.__layout:
+            return
+        self.__layout = layout
+        if self.__thread is None:
+            self.start()
+        else:
+            self.signal()
+
+    def start(self):
+        """starts watching in a background thread, returns False without any alarm attribute"""
+        self.__layout = self.get_layout()
+        if self.__wakeup is None:
+            self.__wakeup = os.pipe()
+            for fd in self.__wakeup:
+                os.set_blocking(fd, False)
+        if not self.open():
+            self.close()
+            self.restore()
+            return False
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.run, name="fctrl-alarms", daemon=True)
+        self.__thread.start()
+        return True
+
+    def stop(self):
+        """stops watching and restores the original limits"""
+        self.__stopped.set()
+        self.signal()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.close()
+        self.restore()
+        if self.__wakeup is not None:
+            for fd in self.__wakeup:
+                os.close(fd)
+            self.__wakeup = None
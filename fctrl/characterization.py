@@ -0,0 +1,74 @@
+# coding=utf-8
+"""runs fan probing and characterization on independent hwmon chips in parallel"""
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+
+class Characterizer:
+    """runs a job(device, out) (e.g. calling CoolingDevice.test_exists) for every device
+
+    devices on different hwmon chips run in parallel, devices on the same chip one after another while the
+    other fans of that chip are held at safe_speed. at most max_parallel jobs run at once (by default half of
+    the devices), so at least half of all fans keep moving air at any time. each job prints to its own
+    buffer out, which is printed en bloc once the job finished."""
+
+    def __init__(self, devices, safe_speed=50, max_parallel=None):
+        self.devices = list(devices)
+        self.safe_speed = safe_speed
+        self.max_parallel = max_parallel if max_parallel is not None else max(len(self.devices) // 2, 1)
+        self.durations = {}
+        self.elapsed = 0
+        self.__output_lock = threading.Lock()
+
+    def get_chips(self):
+        """returns devices grouped by hwmon chip"""
+        chips = {}
+        for device in self.devices:
+            chips.setdefault(os.path.dirname(device.base_path), []).append(device)
+        return list(chips.values())
+
+    @property
+    def sequential_time(self):
+        """returns sum of all job durations, i.e. the time running them one after another would take"""
+        return sum(self.durations.values())
+
+    def run(self, job):
+        """runs job(device, out) for all devices, returns dict device -> result"""
+        results = {}
+
+        def run_chip(chip):
+            for device in chip:
+                for other in chip:
+                    if other is not device:
+                        other.set_speed(self.safe_speed)
+
+                out = io.StringIO()
+                start = monotonic()
+                try:
+                    results[device] = job(device, out)
+                except Exception as e:
+                    results[device] = False
+                    out.write("\nERROR: " + str(e) + "\n")
+                self.durations[device] = monotonic() - start
+                device.set_speed(self.safe_speed)
+
+                text = out.getvalue()
+                with self.__output_lock:
+                    sys.stdout.write(text if text.endswith("\n") else text + "\n")
+                    sys.stdout.flush()
+
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=self.max_parallel) as executor:
+            for future in [executor.submit(run_chip, chip) for chip in self.get_chips()]:
+                future.result()
+        self.elapsed = monotonic() - start
+        return results
+
+    def summary(self):
+        """returns human readable timing summary"""
+        return "{} devices in {}s ({}s one after another)".format(
+            len(self.durations), round(self.elapsed, 1), round(self.sequential_time, 1))
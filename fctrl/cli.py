@@ -233,7 +233,7 @@ class Cli:
             raise
 
 
-def print_table(names, data, spacing=None):
+def print_table(names, data, spacing=None, file=None):
 
     if names is not None:
         data.insert(0, names)
@@ -250,9 +250,9 @@ def print_table(names, data, spacing=None):
 
     for i, row in enumerate(data):
         line = ''.join(str(x).ljust(spacing[ix]) for ix, x in enumerate(row))
-        print(line)
+        print(line, file=file)
         if i == 0 and names is not None:
-            print('-' * len(line))
+            print('-' * len(line), file=file)
 
 
 def printl(*args, **kwargs):
@@ -1,53 +1,108 @@
 #!/usr/bin/env python3.6
 # coding=utf-8
 
-from fctrl import FanControl
-import detection_dialog
+# heavy modules (fctrl, detection_dialog, prettytable) are imported by the commands needing them, so --help and
+# queries answered by the daemon start fast
+from control_client import ControlClient, ControlError
 import os
+import json
 import click
-from prettytable import PrettyTable
 
 
-control = FanControl()
+control = None
+
+
+def get_control():
+    """returns local FanControl, created on first use"""
+    global control
+    if control is None:
+        from fctrl import FanControl
+        control = FanControl()
+    return control
+
+
+def config_transaction():
+    """returns lock held while the config is read, modified and saved"""
+    from config import ConfigLock
+    from fctrl import FanControl
+    return ConfigLock(FanControl.config_path)
+
+
+def get_client():
+    """returns client connected to the running daemon, None if it is not running"""
+    client = ControlClient()
+    try:
+        client.request("status")
+    except OSError:
+        return None
+    return client
 
 
 @click.group()
-def cli():
-    pass
+@click.option("--local", "-l", is_flag=True, help="Do not ask the running daemon, read sysfs and config directly")
+@click.pass_context
+def cli(ctx, local):
+    ctx.obj = None if local else get_client()
 
 
-def list_thermal_zones():
+def list_thermal_zones(client):
+    from prettytable import PrettyTable
     print("Thermal Zones")
 
     table = PrettyTable()
     table.field_names = ["name", "°C", "score", "idle", "desired", "critical"]
 
-    for zone in control.thermal_manager.thermal_zones:
-        table.add_row([zone.full_name, zone.temp, zone.score, zone.idle, zone.desired, zone.critical])
+    if client is not None:
+        for zone in client.request("zones"):
+            table.add_row([zone["name"], zone["temp"], zone["score"], zone["idle"], zone["desired"],
+                           zone["critical"]])
+    else:
+        for zone in get_control().thermal_manager.thermal_zones:
+            table.add_row([zone.full_name, zone.temp, zone.score, zone.idle, zone.desired, zone.critical])
 
     print(table)
 
 
-def list_cooling_devices():
+def list_cooling_devices(client):
+    from prettytable import PrettyTable
     print("Cooling Devices")
 
     table = PrettyTable()
     table.field_names = ["name", "%", "rpm", "started", "thermal zones", "is pump"]
-    for device in control.cooling_manager.cooling_devices:
-        table.add_row([device.name, device.speed, device.rpm,device.started,
-                       [z.full_name for z in device.thermal_zones],
-                       "yes" if device.is_pump else "no"])
+    if client is not None:
+        for device in client.request("devices"):
+            speed = device["speed"] if device["forced-speed"] is None else str(device["forced-speed"]) + " (forced)"
+            table.add_row([device["name"], speed if isinstance(speed, str) else round(speed), device["rpm"],
+                           device["started"], device["thermal-zones"], "yes" if device["is-pump"] else "no"])
+    else:
+        for device in get_control().cooling_manager.cooling_devices:
+            table.add_row([device.name, device.speed, device.rpm, device.started,
+                           [z.full_name for z in device.thermal_zones],
+                           "yes" if device.is_pump else "no"])
     print(table)
 
 
 @cli.command("list")
 @click.option("--thermal", "-t", is_flag=True, help="List all thermal zones")
 @click.option("--cooling", "-c", is_flag=True, help="List all cooling zones")
-def print_list(thermal, cooling):
+@click.pass_obj
+def print_list(client, thermal, cooling):
     if thermal:
-        list_thermal_zones()
+        list_thermal_zones(client)
     if cooling:
-        list_cooling_devices()
+        list_cooling_devices(client)
+
+
+def check_curve(ctx, param, value):
+    """validates the --curve option, returns it unchanged"""
+    if value is None or value == "default":
+        return value
+    from curves import load_curve
+    try:
+        load_curve(json.loads(value))
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    return value
 
 
 @cli.command("set")
@@ -57,7 +112,71 @@ def print_list(thermal, cooling):
 @click.option("--criticaltemp", "-ct", type=int, help="Set the critical temp for thermal zone")
 @click.option("--add-thermal-zone", "-at", type=str, help="Add thermal zone to cooling device")
 @click.option("--rem-thermal-zone", "-rt", type=str, help="Remove thermal zone from cooling device")
-def set_idle_temp(zone, idletemp, desiredtemp, criticaltemp, add_thermal_zone, rem_thermal_zone):
+@click.option("--curve", "-cv", type=str, callback=check_curve,
+              help="Set fan curve of cooling device as json, e.g. "
+                   "'{\"type\": \"linear\", \"points\": [[1, 20], [3, 100]]}' or 'default'")
+@click.pass_obj
+def set_idle_temp(client, zone, idletemp, desiredtemp, criticaltemp, add_thermal_zone, rem_thermal_zone, curve):
+    if client is not None and not any((add_thermal_zone, rem_thermal_zone, curve)):
+        # thresholds only: the daemon applies and saves them
+        try:
+            result = client.request("set-thresholds", zone=zone, idle=idletemp, desired=desiredtemp,
+                                    critical=criticaltemp)
+        except ControlError as e:
+            raise click.ClickException(str(e))
+        for temp_name, value in (("idle", idletemp), ("desired", desiredtemp), ("critical", criticaltemp)):
+            if value:
+                print("Set {} temperature of zone {} to {} °C.".format(temp_name, zone, result[temp_name]))
+        return
+
+    with config_transaction():
+        apply_changes(zone, idletemp, desiredtemp, criticaltemp, add_thermal_zone, rem_thermal_zone, curve)
+        get_control().save()
+
+
+@cli.command("batch")
+@click.argument("file", type=click.File("r"), default="-")
+def batch(file):
+    """Apply several set commands (one per line, e.g. "CPU -dt 60") at once"""
+    import shlex
+    changes = []
+    for line in file:
+        args = shlex.split(line, comments=True)
+        if args[:1] == ["set"]:
+            args = args[1:]
+        if args:
+            # parse everything first, a broken line leaves the config untouched
+            changes.append(set_idle_temp.make_context("set", args).params)
+
+    # one transaction: changes of other cli calls in between loading and saving would be lost
+    with config_transaction():
+        for params in changes:
+            apply_changes(**params)
+        get_control().save()
+
+
+@cli.command("force")
+@click.argument("device")
+@click.argument("speed", type=int, required=False)
+@click.option("--release", "-r", is_flag=True, help="Return cooling device to normal control")
+@click.pass_obj
+def force(client, device, speed, release):
+    """Hold cooling device at SPEED % in the running daemon"""
+    if client is None:
+        raise click.ClickException("fctrl daemon is not running")
+    try:
+        if release or speed is None:
+            client.request("release", device=device)
+            print("Released device {}.".format(device))
+        else:
+            client.request("force-speed", device=device, speed=speed)
+            print("Forced device {} to {} %.".format(device, speed))
+    except ControlError as e:
+        raise click.ClickException(str(e))
+
+
+def apply_changes(zone, idletemp, desiredtemp, criticaltemp, add_thermal_zone, rem_thermal_zone, curve):
+    control = get_control()
 
     if any((criticaltemp, idletemp, desiredtemp)):
         zone = control.thermal_manager.get_zone(full_name=zone)
@@ -76,6 +195,13 @@ def set_idle_temp(zone, idletemp, desiredtemp, criticaltemp, add_thermal_zone, r
             zone.critical = criticaltemp
             print_confimation("critical", zone.critical)
 
+    if curve:
+        device = control.cooling_manager.get_device(name=zone)
+        if device is None:
+            raise click.ClickException("Unknown cooling device " + zone)
+        device.set_curve(None if curve == "default" else json.loads(curve))
+        print("Set fan curve of device {}.".format(device.name))
+
     if any((add_thermal_zone, rem_thermal_zone)):
         device = control.cooling_manager.get_device(name=zone)
         if add_thermal_zone:
@@ -86,21 +212,61 @@ def set_idle_temp(zone, idletemp, desiredtemp, criticaltemp, add_thermal_zone, r
         if rem_thermal_zone:
             device.thermal_zones = [z for z in device.thermal_zones if z.full_name != rem_thermal_zone]
 
-    control.save()
 
+@cli.command("replay")
+@click.argument("trace", type=click.Path(exists=True, dir_okay=False))
+@click.option("--config", "-c", "config_path", type=click.Path(exists=True, dir_okay=False),
+              help="Config to replay with, default is the installed one")
+@click.option("--zone", "-z", multiple=True, help="Thermal zone a legacy trace applies to, default is all zones")
+@click.option("--interval", "-i", type=float, default=1, help="Seconds between the samples of a legacy trace")
+@click.option("--output", "-o", type=click.File("w"), help="Write the duty timeline as csv")
+def replay(trace, config_path, zone, interval, output):
+    """Run a recorded temperature TRACE through the fan control faster than real time
 
-@cli.command("detect")
-def detect():
-    global control
-    if detection_dialog.detect(control):
-        control.save()
-        print("Saved succesfully")
+    Ticks follow the polling intervals of the config, the trace is interpolated between its samples."""
+    from prettytable import PrettyTable
+    from fctrl import FanControl
+    from replay import Replay, load_trace
+    with open(config_path or FanControl.config_path) as file:
+        data = json.load(file)
+    result = Replay(data).run(load_trace(trace, interval, list(zone) or None))
+    summary = result.summary()
+    print("Replayed {:.0f} s in {:.2f} s ({:.0f}x), {} pwm writes, {} ticks ({})".format(
+        summary["duration"], summary["wall-time"], summary["speedup"] or 0, summary["pwm-writes"], summary["ticks"],
+        ", ".join("{} {}".format(count, mode) for mode, count in summary["polling"].items())))
 
+    table = PrettyTable()
+    table.field_names = ["name", "mean %", "max %", "starts", "changes", "travel %", "stopped"]
+    for name, device in summary["devices"].items():
+        table.add_row([name, round(device["mean"], 1), round(device["max"], 1), device["starts"], device["changes"],
+                       round(device["travel"]), "{:.0%}".format(device["stopped"])])
+    print(table)
 
-if __name__ == "__main__":
+    table = PrettyTable()
+    table.field_names = ["name", "max °C", "mean °C", "s > desired", "s > critical"]
+    for name, zone_summary in summary["zones"].items():
+        table.add_row([name, round(zone_summary["max"], 1), round(zone_summary["mean"], 1),
+                       zone_summary["above-desired"], zone_summary["above-critical"]])
+    print(table)
+
+    if output is not None:
+        result.write_csv(output)
+
+
+@cli.command("detect")
+def detect():
+    # detection takes over the fans
     os.system("sudo systemctl stop fctrl.service")
+    import detection_dialog
     try:
-        cli()
+        with config_transaction():
+            control = get_control()
+            if detection_dialog.detect(control):
+                control.save()
+                print("Saved succesfully")
     finally:
         os.system("sudo systemctl start fctrl.service")
 
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,106 @@
+# coding=utf-8
+"""atomic config writes, config locking and change detection"""
+import fcntl
+import os
+import struct
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+def write_atomic(path, content):
+    """writes content to a temporary file next to path and renames it over path, readers see the old or the new
+    file but never a partial one"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+
+
+class ConfigLock:
+    """exclusive lock (flock on path.lock) serializing read-modify-write cycles of the config"""
+
+    def __init__(self, path):
+        self.path = path + ".lock"
+        self.__file = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.__file = open(self.path, "a")
+        fcntl.flock(self.__file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.__file, fcntl.LOCK_UN)
+        self.__file.close()
+        self.__file = None
+
+
+class ConfigWatcher:
+    """detects changes of a config file, with inotify on its directory if available (fileno can be waited on)
+    and by comparing stat results otherwise"""
+
+    def __init__(self, path):
+        self.path = path
+        self.__fd = None
+        self.__stat = self.__get_stat()
+        self.__open_inotify()
+
+    def __get_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def __open_inotify(self):
+        # only the daemon watches the config, keep ctypes out of the cli start
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        directory = os.path.dirname(self.path) or "."
+        if libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            return
+        self.__fd = fd
+
+    def fileno(self):
+        """returns inotify file descriptor, readable on changes, None when falling back to polling"""
+        return self.__fd
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+    def changed(self):
+        """returns whether the config changed since the last call"""
+        if self.__fd is None:
+            stat = self.__get_stat()
+            changed, self.__stat = stat != self.__stat, stat
+            return changed
+
+        name = os.path.basename(self.path)
+        changed = False
+        while True:
+            try:
+                buffer = os.read(self.__fd, 4096)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(buffer):
+                _, _, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+                offset += INOTIFY_EVENT.size
+                if buffer[offset:offset + length].rstrip(b"\0").decode(errors="replace") == name:
+                    changed = True
+                offset += length
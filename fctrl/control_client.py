@@ -0,0 +1,56 @@
+# coding=utf-8
+"""client of the daemons unix socket, kept free of heavy imports for a fast cli start"""
+import json
+import socket
+
+SOCKET_PATH = "/run/fctrl.sock"
+
+
+class ControlError(Exception):
+    """error reported by the daemon"""
+    pass
+
+
+class ControlClient:
+    """blocking client of ControlServer, raises OSError if the daemon is not running"""
+
+    def __init__(self, path=None, timeout=2):
+        self.path = path if path is not None else SOCKET_PATH
+        self.timeout = timeout
+        self.__socket = None
+        self.__file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.__socket is not None:
+            self.__file.close()
+            self.__socket.close()
+            self.__socket = self.__file = None
+
+    def request(self, cmd, **params):
+        """sends a request, returns its result"""
+        if self.__socket is None:
+            self.__socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.__socket.settimeout(self.timeout)
+            try:
+                self.__socket.connect(self.path)
+            except OSError:
+                self.__socket.close()
+                self.__socket = None
+                raise
+            self.__file = self.__socket.makefile("rb")
+
+        params["cmd"] = cmd
+        self.__socket.sendall(json.dumps(params).encode() + b"\n")
+        line = self.__file.readline()
+        if not line:
+            raise ConnectionError("daemon closed the connection")
+        response = json.loads(line)
+        if not response["ok"]:
+            raise ControlError(response["error"])
+        return response["result"]
@@ -0,0 +1,148 @@
+# coding=utf-8
+"""unix socket control and query interface of the running daemon"""
+import asyncio
+import json
+import os
+from config import ConfigLock
+from control_client import ControlError, SOCKET_PATH
+
+
+class ControlServer:
+    """serves the running FanControl on a unix socket (root only)
+
+    the protocol is one json object per line in both directions, several requests may be sent over one
+    connection. requests are {"cmd": command, ...parameters}, responses {"ok": true, "result": ...} or
+    {"ok": false, "error": message}. commands are answered from the state of the control loop, they never
+    touch sysfs except for values missing in the latest snapshot."""
+
+    def __init__(self, control, engine, path=SOCKET_PATH):
+        self.control = control
+        self.engine = engine
+        self.path = path
+        self.requests = 0
+        self.commands = {"snapshot": self.get_snapshot, "zones": self.get_zones, "devices": self.get_devices,
+                         "status": self.get_status, "set-thresholds": self.set_thresholds,
+                         "force-speed": self.force_speed, "release": self.release}
+
+    async def serve(self):
+        """serves until cancelled"""
+        server = await asyncio.start_unix_server(self.handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        try:
+            await asyncio.Future()
+        finally:
+            server.close()
+            await server.wait_closed()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(json.dumps(self.handle_request(line)).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def handle_request(self, line):
+        """returns response dict for a request line"""
+        self.requests += 1
+        try:
+            request = json.loads(line)
+            command = self.commands[request.pop("cmd")]
+            return {"ok": True, "result": command(**request)}
+        except KeyError as e:
+            return {"ok": False, "error": "unknown command or parameter " + str(e)}
+        except Exception as e:
+            # a failing command must not take the connection (or the loop) down
+            return {"ok": False, "error": str(e) or e.__class__.__name__}
+
+    def get_zone(self, name):
+        zone = self.control.thermal_manager.get_zone(full_name=name)
+        if zone is None:
+            raise ControlError("no thermal zone " + name)
+        return zone
+
+    def get_device(self, name):
+        cooling_manager = self.control.cooling_manager
+        device = cooling_manager.get_device(name=name) or cooling_manager.get_device(full_name=name)
+        if device is None:
+            raise ControlError("no cooling device " + name)
+        return device
+
+    def get_snapshot(self):
+        """returns readings of the latest tick by path"""
+        snapshot = self.control.sampler.snapshot
+        if snapshot is None:
+            return None
+        return {"tick": snapshot.tick, "time": snapshot.time, "values": dict(snapshot.values)}
+
+    def get_zones(self):
+        return [{"name": zone.full_name, "temp": zone.temp, "score": zone.score, "idle": zone.idle,
+                 "desired": zone.desired, "critical": zone.critical}
+                for zone in self.control.thermal_manager.thermal_zones]
+
+    def get_devices(self):
+        cooling_manager = self.control.cooling_manager
+        devices = []
+        for device in cooling_manager.cooling_devices:
+            data = {"name": device.name, "full-name": device.full_name, "speed": device.buffer_speed,
+                    "rpm": device.rpm, "thermal-zones": [zone.full_name for zone in device.thermal_zones],
+                    "is-pump": device.is_pump, "control-mode": device.control_mode,
+                    "forced-speed": cooling_manager.forced_speeds.get(device.full_name)}
+            data.update(device.get_state())
+            devices.append(data)
+        return devices
+
+    def get_status(self):
+        """returns loop statistics"""
+        engine, cooling_manager = self.engine, self.control.cooling_manager
+        return {"tick": engine.tick, "interval": engine.interval, "missed-ticks": engine.missed_ticks,
+                "polling-mode": self.control.polling.mode, "write-stats": cooling_manager.get_write_stats(),
+                "evaluation-stats": cooling_manager.get_evaluation_stats(),
+                "stalled": cooling_manager.watchdog.get_stats()["stalled"],
+                "scheduler": engine.scheduler.get_stats()}
+
+    def set_thresholds(self, zone, idle=None, desired=None, critical=None, save=True):
+        """sets thresholds of zone in °C, saves them to the config unless save is false
+
+        the config is re-read and saved under the config lock, so changes of a concurrent cli transaction are
+        kept"""
+        if not save:
+            zone = self.__set_thresholds(zone, idle, desired, critical)
+        else:
+            with ConfigLock(self.control.config_path):
+                self.control.reload()
+                zone = self.__set_thresholds(zone, idle, desired, critical)
+                self.control.save()
+        self.engine.wake()
+        return {"idle": zone.idle, "desired": zone.desired, "critical": zone.critical}
+
+    def __set_thresholds(self, name, idle, desired, critical):
+        zone = self.get_zone(name)
+        new = [zone.idle if idle is None else idle, zone.desired if desired is None else desired,
+               zone.critical if critical is None else critical]
+        if any(isinstance(value, bool) or not isinstance(value, (int, float)) for value in new):
+            raise ControlError("thresholds have to be numbers")
+        if not new[0] <= new[1] < new[2]:
+            raise ControlError("thresholds have to be idle <= desired < critical, got {} {} {}".format(*new))
+        zone.set_thresholds(idle, desired, critical)
+        return zone
+
+    def force_speed(self, device, speed):
+        """holds device at speed in % until released"""
+        self.control.cooling_manager.force_speed(self.get_device(device), speed)
+        self.engine.wake()
+        return speed
+
+    def release(self, device=None):
+        """returns device (all if None) to normal control"""
+        self.control.cooling_manager.release(None if device is None else self.get_device(device))
+        self.engine.wake()
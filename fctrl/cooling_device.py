@@ -1,8 +1,11 @@
-from time import sleep
 from file_ops import *
-from cli import print_table
+from telemetry import telemetry
+from curves import load_curve
+from filters import scale_alpha
+from fan_model import FanModel
+from rpm_control import RpmController
+from settle import SettleDetector
 import os
-import math
 
 
 def lerp(a, b, alpha):
@@ -26,12 +29,23 @@ class CoolingDevice:
         self.__index = -1
         self.__base_path = ""
         self.__base_dir = ""
+        self.__pwm = None
+        self.__pwm_deadband = 0
+        self.__pwm_refresh = 30
+        self.__fan_input = None
         self.hwmon = None
         self.hwmon_name = ""
 
         self.__name = str(self.__index)
-        self.threshold_speed = 0
-        self.rpm_curve = []
+        self.__curve_data = None
+        self.__curve = None
+        self.__threshold_speed = 0
+        self.__rpm_curve = []
+        self.__rpm_points = []
+        self.__fan_model = FanModel([])
+        self.control_mode = "duty"
+        self.__rpm_control_data = {}
+        self.__rpm_controller = RpmController(self.__fan_model)
         self.is_pump = False
 
         self.thermal_zones = []
@@ -39,6 +53,7 @@ class CoolingDevice:
         self.__started = False
 
         self.__responsiveness = 10
+        self.settle_detector = SettleDetector(lambda: self.rpm)
 
         self.__buffer_speed = 0
         self.__build_up = 0
@@ -50,6 +65,7 @@ class CoolingDevice:
 
         if data is not None:
             self.load_json(data)
+        self.set_curve(self.__curve_data)
         self.load_thermal_data()
         # if data is not None:
         #    self.load_json(data)
@@ -65,6 +81,13 @@ class CoolingDevice:
         self.hwmon = hwmon
         self.hwmon_name = hwmon.name
         self.__name = str(self.__index)
+        self.__open_attributes()
+
+    def __open_attributes(self):
+        """creates persistent sysfs handles for pwm and fan input"""
+        self.__pwm = ShadowRegister(get_attribute(self.__base_path), deadband=self.__pwm_deadband,
+                                    refresh_interval=self.__pwm_refresh)
+        self.__fan_input = get_attribute(self.get_path(fan=True) + "_input")
 
     def load_json(self, data):
         self.set_name(data["name"])
@@ -73,14 +96,22 @@ class CoolingDevice:
             self.threshold_speed = int(data["threshold-speed"])
         except (ValueError, TypeError, KeyError):
             self.threshold_speed = 0
+        self.__rpm_points = data.get("rpm-points", [])
+        self.control_mode = data.get("control-mode", "duty")
+        self.__rpm_control_data = data.get("rpm-control", {})
         try:
             self.rpm_curve = data["rpm-curve"]
         except (ValueError, TypeError, KeyError):
             self.rpm_curve = []
 
+        self.__curve_data = data.get("curve")
+        self.__pwm_deadband = data.get("pwm-deadband", 0)
+        self.__pwm_refresh = data.get("pwm-refresh", 30)
+
         self.__base_path = data["base-path"]
         self.__base_dir = os.path.dirname(self.__base_path)
         self.hwmon_name = data["hwmon"]
+        self.__open_attributes()
 
         if "is-pump" in data:
             self.is_pump = data["is-pump"]
@@ -91,11 +122,17 @@ class CoolingDevice:
             if zone is not None:
                 self.thermal_zones.append(zone)
 
+        if self.control_mode == "rpm" and not self.__rpm_controller.has_model:
+            telemetry.event("rpm-control-unavailable", "warning", device=self.full_name,
+                            reason="no fan model, run the detection, controlling duty")
+
     def get_json(self):
         """return data as dict for json"""
         return {"name": self.__name, "index": self.__index, "base-path": self.__base_path, "hwmon": self.hwmon_name,
-                "threshold-speed": self.threshold_speed, "rpm-curve": self.rpm_curve,
-                "is-pump": self.is_pump, "thermal-zones": [z.full_name for z in self.thermal_zones]}
+                "threshold-speed": self.threshold_speed, "rpm-curve": self.rpm_curve, "rpm-points": self.rpm_points,
+                "control-mode": self.control_mode, "rpm-control": self.__rpm_control_data,
+                "is-pump": self.is_pump, "thermal-zones": [z.full_name for z in self.thermal_zones],
+                "pwm-deadband": self.__pwm_deadband, "pwm-refresh": self.__pwm_refresh, "curve": self.__curve_data}
 
     @property
     def index(self):
@@ -107,6 +144,11 @@ class CoolingDevice:
         """returns name"""
         return self.__name
 
+    @property
+    def base_path(self):
+        """returns path of pwm file"""
+        return self.__base_path
+
     @property
     def full_name(self):
         """returns current temparture of thermal zone in °C"""
@@ -119,6 +161,52 @@ class CoolingDevice:
         """returns max speed"""
         return self.rpm_curve[-1]
 
+    @property
+    def rpm_curve(self):
+        """returns rpm at 0%, 10%, ... 100% speed"""
+        return self.__rpm_curve
+
+    @rpm_curve.setter
+    def rpm_curve(self, value):
+        self.__rpm_curve = value
+        self.__update_fan_model()
+
+    @property
+    def rpm_points(self):
+        """returns finer [[speed, rpm, ...], ...] measurements, empty if only rpm_curve is known"""
+        return self.__rpm_points
+
+    @rpm_points.setter
+    def rpm_points(self, value):
+        self.__rpm_points = value
+        self.__update_fan_model()
+
+    def __update_fan_model(self):
+        self.__fan_model = FanModel.from_rpm_curve(self.__rpm_curve, self.__rpm_points)
+        self.__rpm_controller = RpmController(self.__fan_model, self.__rpm_control_data)
+
+    @property
+    def rpm_controller(self):
+        """returns RpmController used in rpm control mode"""
+        return self.__rpm_controller
+
+    @property
+    def fan_model(self):
+        """returns FanModel built from rpm_points or rpm_curve"""
+        return self.__fan_model
+
+    @property
+    def threshold_speed(self):
+        """returns minimal speed in % at which the fan starts"""
+        return self.__threshold_speed
+
+    @threshold_speed.setter
+    def threshold_speed(self, value):
+        self.__threshold_speed = value
+        # the default curve is scaled between threshold speed and 100%
+        if self.__curve is not None:
+            self.set_curve(self.__curve_data)
+
     @property
     def started(self):
         """returns started"""
@@ -131,90 +219,91 @@ class CoolingDevice:
     @property
     def speed(self):
         """returns current speed in %"""
-        content = read_all(self.__base_path)
-        try:
-            speed = int(content)
-        except (ValueError, TypeError):
+        speed = self.mng.sampler.read_int(self.__pwm.attribute)
+        if speed is None:
             return None
 
         return int(round((speed/255) * 100))
 
+    @property
+    def write_stats(self):
+        """returns written and suppressed pwm write counts"""
+        return self.__pwm.get_stats()
+
     def set_speed(self, new_speed):
-        """sets speed"""
+        """sets speed, writes inside the pwm deadband are suppressed"""
         self.__buffer_speed = new_speed
         new_speed = int(round(max(min(new_speed/100*255, 255), 0)))
-        return write(self.__base_path, new_speed)
+        return self.__pwm.write(new_speed)
 
     @property
     def rpm(self):
         """returns current fan rpm"""
-        data = read_all(self.get_path(fan=True)+"_input")
-        try:
-            return int(data)
-        except (TypeError, ValueError):
-            return None
+        return self.mng.sampler.read_int(self.__fan_input)
 
-    def __get_actual_speed(self):
+    @property
+    def actual_speed(self):
+        """returns range of speed in % matching the measured rpm, (0, 0) if unknown"""
         accuracy = 2
-        start = -1
-        end = -1
-        rpm = self.rpm
-        for i, val in enumerate(self.rpm_curve):
-
-            if val >= rpm and end == -1:
-                end = (10 * i, val)
-
-            if val <= rpm:
-                start = (10 * i, val)
-        if start == -1 or end == -1:
+        speed_range = self.__fan_model.speed(self.rpm)
+        if speed_range is None:
             return 0, 0
+        low, high = int(round(speed_range[0])), int(round(speed_range[1]))
+        return min(max(low - accuracy, 0), 100), min(max(high + accuracy, 0), 100)
 
-        if start[0] > end[0]:
-            start, end = end, start
+    @property
+    def buffer_speed(self):
+        """returns last commanded speed in %"""
+        return self.__buffer_speed
 
-        if start[1] == end[1]:
-            return start[0] - accuracy, end[0] + accuracy
-        elif end[0] - start[0] == 10:
-            alpha = (rpm - start[1]) / (end[1] - start[1])
-            actual_speed = int(round(lerp(start[0], end[0], alpha)))
-            return actual_speed - accuracy, actual_speed + accuracy
-        else:
-            return start[0] - accuracy, end[0] + accuracy
+    @property
+    def build_up(self):
+        """returns build up"""
+        return self.__build_up
 
     @property
-    def actual_speed(self):
-        act_speed = self.__get_actual_speed()
-        return min(max(act_speed[0], 0), 100), min(max(act_speed[1], 0), 100)
+    def build_up_thresholds(self):
+        """returns build up thresholds (idle, desired) after which the fan starts"""
+        return self.__build_up_thresh_idle, self.__build_up_thresh_desired
+
+    def get_state(self):
+        """returns controller state as dict"""
+        return {"started": self.__started, "build-up": self.__build_up, "responsiveness": self.__responsiveness,
+                "buffer-speed": self.__buffer_speed}
+
+    def set_state(self, state):
+        """restores controller state from get_state"""
+        self.__started = state.get("started", self.__started)
+        self.__build_up = state.get("build-up", self.__build_up)
+        self.__responsiveness = state.get("responsiveness", self.__responsiveness)
+        self.__buffer_speed = state.get("buffer-speed", self.__buffer_speed)
 
     def guess_is_responsive(self):
         return self.__responsiveness > 0
 
-    def wait_for_fan_response(self, response, timeout=15, p=False):
-        slept = 0
-        while not (response(self)):
-            sleep(1)
-            if p:
-                print("#", end="", flush=True)
-            slept += 1
-            if slept > timeout:
-                return False
+    def wait_for_fan_response(self, response, timeout=15, window=None, budget=None, p=False, out=None):
+        """waits until response(self) holds and the fan rpm is steady for window seconds, False on timeout"""
+        return self.settle_detector.wait(condition=lambda rpm: response(self), timeout=timeout, window=window,
+                                         budget=budget, p=p, out=out)
 
-        if p:
-            print("#", end="", flush=True)
-        return True
+    def wait_for_steady_rpm(self, budget=None, p=False, out=None, **kwargs):
+        """waits until the fan rpm is steady, False on timeout"""
+        return self.settle_detector.wait(budget=budget, p=p, out=out, **kwargs)
 
     def set_to_manual(self):
         write(self.__base_path + "_enable", "1")
+        # the chip may have changed the duty cycle while in automatic mode
+        self.__pwm.invalidate()
 
     def test_exists(self):
         self.set_to_manual()
 
         self.set_speed(0)
-        sleep(3)
+        self.wait_for_steady_rpm(budget=3, timeout=6)
         rpm_1 = self.rpm
 
         self.set_speed(100)
-        sleep(5)
+        self.wait_for_steady_rpm(budget=5, timeout=10)
         rpm_2 = self.rpm
 
         self.set_speed(40)
@@ -242,45 +331,79 @@ class CoolingDevice:
             score = max(score, zone.score)
         return score
 
-    def _update_responsiveness(self):
+    def is_responsive(self):
+        """returns whether the measured rpm matches the command: the target rpm of the controller in rpm control
+        mode (its duty deliberately differs from the fan model), the commanded speed otherwise"""
+        if self.rpm_control_active and self.__rpm_controller.target_rpm is not None:
+            return self.__rpm_controller.is_responsive(self.rpm)
         act_speed = self.actual_speed
-        if act_speed[0] <= self.__buffer_speed <= act_speed[1]:
-            self.__responsiveness += 1
+        return act_speed[0] <= self.__buffer_speed <= act_speed[1]
+
+    @property
+    def rpm_control_active(self):
+        """returns whether the device runs in rpm control mode, which needs a fan model"""
+        return self.control_mode == "rpm" and self.__rpm_controller.has_model
+
+    def _update_responsiveness(self, responsive=None):
+        scale = self.mng.sampler.get_time_scale()
+        if responsive is None:
+            responsive = self.is_responsive()
+        if responsive:
+            self.__responsiveness += scale
         else:
-            self.__responsiveness -= 1
+            self.__responsiveness -= scale
 
         self.__responsiveness = max(min(self.__responsiveness, 15), -15)
 
         if not self.guess_is_responsive():
-            print("Not reponsive!")
+            telemetry.event("not-responsive", "warning", device=self.full_name)
             self.set_to_manual()
             self.__responsiveness = 10
 
     def respond_to_crititcal(self):
         self.set_speed(100)
 
+    @property
+    def curve(self):
+        """returns compiled fan curve"""
+        return self.__curve
+
+    def set_curve(self, data=None):
+        """compiles fan curve described by data (None for the default curve) and swaps it in"""
+        curve = load_curve(data, self.threshold_speed)
+        self.__curve_data = data
+        self.__curve = curve
+
     def get_curve_speed(self, speed):
-        # print(math.e ** (0.046*(speed)+10) * ((100 - self.threshold_speed) / 100) + self.threshold_speed)
-        return math.e ** (0.046*(speed+10)) * ((100 - self.threshold_speed) / 100) + self.threshold_speed
+        """returns curve speed in % for speed = 100 * (score - 2)"""
+        return self.__curve(speed / 100 + 2)
 
     def update(self):
-        self._update_responsiveness()
+        self.set_speed(self.compute_speed())
+
+    def compute_speed(self, responsive=None):
+        """runs the control step for the current tick, returns the speed to be set in %
+
+        responsive may be precomputed for all devices at once, see CoolingManager.check_responsiveness. build up
+        and smoothing are tuned per base interval and scaled by the length of the tick."""
+        self._update_responsiveness(responsive)
         high_score = self.get_highest_temp_score()
+        scale = self.mng.sampler.get_time_scale()
 
         if high_score < 1:  # under idle
             self.__build_up = 0
 
         elif high_score < 2:  # over idle but under desired
             if self.__build_up < self.__build_up_thresh_idle:
-                self.__build_up += 10 * (high_score-1)
+                self.__build_up += 10 * (high_score-1) * scale
             elif self.__build_up > self.__build_up_thresh_idle + 100:
-                self.__build_up -= 100 * (1-(high_score-1))
+                self.__build_up -= 100 * (1-(high_score-1)) * scale
             elif self.__build_up > self.__build_up_thresh_idle + 10:
-                self.__build_up -= 10 * (1-(high_score-1))
+                self.__build_up -= 10 * (1-(high_score-1)) * scale
 
         elif high_score < 3:  # over desired but under critical
             if self.__build_up < self.__build_up_thresh_desired*1.2:
-                self.__build_up += 100 * (high_score-2)
+                self.__build_up += 100 * (high_score-2) * scale
             if high_score >= 2.7:
                 self.__build_up = self.__build_up_thresh_desired
 
@@ -289,20 +412,22 @@ class CoolingDevice:
 
         if self.__build_up > self.__build_up_thresh_desired:
             self.__started = True
-            speed = self.get_curve_speed(100 * (high_score-2))
+            speed = self.__curve(high_score)
         else:
             self.__started = False
             speed = 0
 
-        debug_data = [self.full_name,
-                      str(round(speed)) + "%",
-                      str(high_score) + "sc",
-                      str(self.get_highest_temp()) + "°C",
-                      str(round(self.__build_up)) + "b"]
-        print_table(None, [debug_data], spacing=[4, 2, 2, 2, 2])
+        if telemetry.enabled("debug"):
+            telemetry.event("device-tick", "debug", device=self.full_name, speed=speed, score=high_score,
+                            temp=self.get_highest_temp(), build_up=self.__build_up)
 
         if not self.__started:
-            self.set_speed(0)
+            self.__rpm_controller.reset()
+            return 0
+        elif self.rpm_control_active:
+            # closed loop: the curve speed is a target rpm, pwm follows the fan input
+            target_rpm = self.__rpm_controller.get_target_rpm(max(speed, self.threshold_speed))
+            return self.__rpm_controller.update(target_rpm, self.rpm, min_speed=self.threshold_speed, scale=scale)
         else:
             speed = max(speed, self.threshold_speed)
 
@@ -312,8 +437,8 @@ class CoolingDevice:
 
             if speed_delta > 15:
                 result = speed
-                print("PEAK detected", own_speed, speed)
+                telemetry.event("speed-peak", "info", device=self.full_name, speed=own_speed, target=speed)
             elif abs(speed_delta) > 3:
-                result = own_speed + speed_delta*0.3
-            self.set_speed(result)
+                result = own_speed + speed_delta*scale_alpha(0.3, scale)
+            return result
 
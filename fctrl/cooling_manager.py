@@ -3,6 +3,15 @@
 import os
 from time import sleep
 from cooling_device import CoolingDevice
+from fan_model import check_responsive
+from watchdog import StallWatchdog
+from registry import Registry
+from telemetry import telemetry
+
+
+def log_alarm(alarm):
+    data = dict(alarm)
+    telemetry.event(data.pop("event"), "warning", **data)
 
 
 class CoolingManager:
@@ -11,14 +20,92 @@ class CoolingManager:
     def __init__(self, control, data):
         self.cooling_devices = []
         self.control = control
+        self.watchdog = StallWatchdog()
+        self.watchdog.add_listener(log_alarm)
+        self.vector_controller = None
+        self.incremental = True
+        self.score_epsilon = 0
+        self.evaluation_stats = {"evaluated": 0, "skipped": 0}
+        self.forced_speeds = {}
+        self.__by_name = Registry(lambda: self.cooling_devices, lambda device: device.name)
+        self.__by_full_name = Registry(lambda: self.cooling_devices, lambda device: device.full_name)
+        self.__dependents = {}
+        self.__dependents_signature = None
+        self.__zone_scores = {}
+        self.__steady = {}
         self.load_all_cooling_devices(data)
 
+    @property
+    def sampler(self):
+        """returns the sampler shared with the thermal manager"""
+        return self.control.thermal_manager.sampler
+
     def load_all_cooling_devices(self, data):
         """load all thermal_zones in self"""
         if data is None:
             return False
         for device in data["devices"]:
             self.cooling_devices.append(CoolingDevice(self, device))
+        self.set_vectorized(data.get("vectorized", False))
+        self.incremental = data.get("incremental", True)
+        self.score_epsilon = data.get("score-epsilon", 0)
+
+    def prepare_json(self, data, zones=None):
+        """loads data (see get_json) without touching the live devices, raises if data is invalid
+
+        devices are linked to zones (the live thermal zones if None), e.g. the ones of ThermalManager.prepare_json.
+        returns a function swapping the devices in. devices with unchanged settings are kept and only get their
+        thermal zones relinked, all others are loaded anew and take over the controller state of the device they
+        replace"""
+        zones = zones if zones is not None else self.control.thermal_manager.thermal_zones
+        zones_by_name = {zone.full_name: zone for zone in zones}
+        vectorized = data.get("vectorized", False)
+        if vectorized:
+            # fails without numpy
+            from vector_controller import VectorController  # noqa: F401
+        devices = []
+        links = []
+        for device_data in data["devices"]:
+            full_name = device_data["name"]
+            if device_data.get("hwmon"):
+                full_name = device_data["hwmon"] + "/" + full_name
+            linked = [zones_by_name[name] for name in device_data["thermal-zones"] if name in zones_by_name]
+            device = self.get_device(full_name=full_name)
+            current = device.get_json() if device is not None else {}
+            if device is None or any(current.get(key) != value for key, value in device_data.items()
+                                     if key != "thermal-zones"):
+                state = device.get_state() if device is not None else None
+                device = CoolingDevice(self, device_data)
+                if state is not None:
+                    device.set_state(state)
+            links.append((device, linked))
+            devices.append(device)
+
+        def commit():
+            for device, linked in links:
+                device.thermal_zones = linked
+                device.load_thermal_data()
+            for device in self.cooling_devices:
+                if device not in devices:
+                    self.watchdog.forget(device)
+            self.cooling_devices = devices
+            if vectorized != (self.vector_controller is not None):
+                self.set_vectorized(vectorized)
+            self.incremental = data.get("incremental", True)
+            self.score_epsilon = data.get("score-epsilon", 0)
+        return commit
+
+    def apply_json(self, data):
+        """applies data (see get_json) to the live devices, see prepare_json"""
+        self.prepare_json(data)()
+
+    def set_vectorized(self, vectorized):
+        """enables the struct of arrays controller (requires numpy) for dense systems"""
+        if vectorized:
+            from vector_controller import VectorController  # noqa: F401
+            self.vector_controller = VectorController(self)
+        else:
+            self.vector_controller = None
 
     def set_all_to_manual(self):
         for d in self.cooling_devices:
@@ -37,12 +124,13 @@ class CoolingManager:
         """returns list of names of all thermal_zones"""
         return [zone.get_name() for zone in self.cooling_devices]
 
-    def get_device(self, index=None, name=None):
-        """returns thermal_zone described in query, None if unavailable"""
+    def get_device(self, index=None, name=None, full_name=None):
+        """returns cooling device described in query, None if unavailable"""
+        if full_name is not None:
+            return self.__by_full_name.get(full_name)
+        if name is not None:
+            return self.__by_name.get(name)
         try:
-            if name is not None:
-                return [device for device in self.cooling_devices if device.name == name][0]
-
             if index is not None and index >= 0:
                 return [zone for zone in self.cooling_devices if zone.index == index][0]
         except IndexError:
@@ -52,8 +140,7 @@ class CoolingManager:
     def get_speed(self, index=None, name=None):
         """returns temperature of thermal_zone described in query in °C, None if unavailable"""
         if name is not None:
-            zones = [zone for zone in self.cooling_devices if zone.get_name() == name]
-            return zones[0].speed
+            return self.get_device(name=name).speed
         if index is not None and index >= 0:
             return self.cooling_devices[index].speed
 
@@ -70,12 +157,130 @@ class CoolingManager:
         """return data as dict for json"""
         data = dict()
         data["devices"] = [device.get_json() for device in self.cooling_devices]
+        data["vectorized"] = self.vector_controller is not None
+        data["incremental"] = self.incremental
+        data["score-epsilon"] = self.score_epsilon
         return data
 
+    def get_write_stats(self):
+        """returns summed written and suppressed pwm write counts of all devices"""
+        stats = {"written": 0, "suppressed": 0}
+        for device in self.cooling_devices:
+            for key, value in device.write_stats.items():
+                stats[key] += value
+        return stats
+
     def set_all_safe_speed(self):
         for device in self.cooling_devices:
             device.set_speed(32)
 
-    def update_devices(self):
+    def get_dependent_devices(self, zone):
+        """returns devices controlled by zone"""
+        self.__update_dependents()
+        return self.__dependents.get(zone, [])
+
+    def __update_dependents(self):
+        """rebuilds the zone -> devices index when devices or their zones changed"""
+        signature = tuple((device, tuple(device.thermal_zones)) for device in self.cooling_devices)
+        if signature == self.__dependents_signature:
+            return
+        self.__dependents_signature = signature
+        self.__dependents = {}
         for device in self.cooling_devices:
-            device.update()
+            for zone in device.thermal_zones:
+                self.__dependents.setdefault(zone, []).append(device)
+        self.__zone_scores = {}
+        self.__steady = {}
+
+    def get_evaluation_stats(self):
+        """returns number of evaluated and skipped device control steps"""
+        return dict(self.evaluation_stats)
+
+    def __compute_incremental(self, devices, responsive):
+        """runs the control step only for devices with a changed zone score or a state still in transition
+
+        a device is steady once a control step left build up and started unchanged and returned its current
+        speed, with unchanged scores it would return the same speed again. skipped devices only update their
+        responsiveness."""
+        self.__update_dependents()
+        changed = set()
+        for zone, dependents in self.__dependents.items():
+            score = zone.score
+            last = self.__zone_scores.get(zone)
+            if last is None or abs(score - last) > self.score_epsilon:
+                self.__zone_scores[zone] = score
+                changed.update(dependents)
+
+        speeds = []
+        for device, r in zip(devices, responsive):
+            speed = self.__steady.get(device)
+            if device not in changed and speed is not None and speed == device.buffer_speed:
+                device._update_responsiveness(r)
+                self.evaluation_stats["skipped"] += 1
+                speeds.append((device, speed))
+                continue
+
+            before = device.get_state()
+            speed = device.compute_speed(r)
+            after = device.get_state()
+            self.evaluation_stats["evaluated"] += 1
+            if not device.rpm_control_active and device.get_highest_temp_score() < 3 and \
+                    before["started"] == after["started"] and before["build-up"] == after["build-up"] and \
+                    speed == before["buffer-speed"]:
+                self.__steady[device] = speed
+            else:
+                self.__steady.pop(device, None)
+            speeds.append((device, speed))
+        return speeds
+
+    def force_speed(self, device, speed):
+        """holds device at speed in % (overriding the curve) until released, stall compensation and critical
+        zones still raise it"""
+        if isinstance(speed, bool) or not isinstance(speed, (int, float)) or not 0 <= speed <= 100:
+            raise ValueError("speed has to be a number within 0 and 100")
+        self.forced_speeds[device.full_name] = speed
+
+    def release(self, device=None):
+        """returns device (all devices if None) to normal control"""
+        if device is None:
+            self.forced_speeds = {}
+        else:
+            self.forced_speeds.pop(device.full_name, None)
+
+    def check_responsiveness(self):
+        """returns for every device whether its measured rpm matches its commanded speed, or the target rpm in
+        rpm control mode (see CoolingDevice.is_responsive)"""
+        devices = self.cooling_devices
+        responsive = check_responsive([d.fan_model for d in devices], [d.rpm for d in devices],
+                                      [d.buffer_speed for d in devices])
+        return [device.is_responsive() if device.rpm_control_active else r for device, r in zip(devices, responsive)]
+
+    def compute_speeds(self):
+        """runs the control step of all devices, returns (device, speed) pairs to be written
+
+        stalled fans are detected before and compensated by the other fans of their zones in the same tick"""
+        devices = self.cooling_devices
+        snapshot = self.sampler.snapshot
+        self.watchdog.check(devices, snapshot.time if snapshot is not None else None)
+        responsive = self.check_responsiveness()
+        if self.vector_controller is None and self.incremental:
+            speeds = self.__compute_incremental(devices, responsive)
+        elif self.vector_controller is None:
+            speeds = [(device, device.compute_speed(r)) for device, r in zip(devices, responsive)]
+        else:
+            responsive = dict(zip(devices, responsive))
+            vector = self.vector_controller
+            vector_speeds = vector.compute_speeds(responsive)
+            vector_speeds = dict(zip(vector.devices, vector_speeds))
+            speeds = [(device, vector_speeds[device] if device in vector_speeds else device.compute_speed(
+                responsive[device])) for device in devices]
+        if self.forced_speeds:
+            speeds = [(device, self.forced_speeds.get(device.full_name, speed)) for device, speed in speeds]
+        speeds = self.watchdog.compensate(speeds, snapshot.time if snapshot is not None else None)
+        # smoke prevention wins over forced speeds and a control step that left the fan stopped
+        return [(device, max(speed, 100) if device.get_highest_temp_score() >= 3 else speed)
+                for device, speed in speeds]
+
+    def update_devices(self):
+        for device, speed in self.compute_speeds():
+            device.set_speed(speed)
@@ -0,0 +1,152 @@
+# coding=utf-8
+"""fan curves and score tables compiled into lookup tables"""
+from abc import ABC, abstractmethod
+from array import array
+import math
+
+
+class LookupTable:
+    """samples a function at equidistant bins once, evaluation is a single index with linear interpolation"""
+
+    def __init__(self, function, start, stop, step):
+        self.start = start
+        self.stop = stop
+        self.step = step
+        count = int(round((stop - start) / step)) + 1
+        self.table = array("d", (function(start + i * step) for i in range(count)))
+        self.__last = count - 1
+
+    def __call__(self, x):
+        position = (x - self.start) / self.step
+        if position <= 0:
+            return self.table[0]
+        index = int(position)
+        if index >= self.__last:
+            return self.table[self.__last]
+        low = self.table[index]
+        return low + (self.table[index + 1] - low) * (position - index)
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+class Curve(ABC):
+    """maps the highest zone score of a device (0 - 3) to a speed in %"""
+    type = ""
+    resolution = 0.01
+
+    def __init__(self, data=None):
+        self.data = dict(data) if data is not None else {"type": self.type}
+        self.table = None
+        self.validate()
+
+    def validate(self):
+        """raises ValueError if data does not describe a valid curve"""
+
+    @abstractmethod
+    def function(self, score, threshold_speed):
+        """returns speed in % at score"""
+
+    def compile(self, threshold_speed=0):
+        """builds the lookup table, returns self"""
+        self.table = LookupTable(lambda score: self.function(score, threshold_speed), 0, 3, self.resolution)
+        return self
+
+    def __call__(self, score):
+        return self.table(score)
+
+    def get_json(self):
+        """return data as dict for json"""
+        return self.data
+
+
+class ExponentialCurve(Curve):
+    """default fctrl curve: e^(rate * (100 * (score - 2) + offset)), scaled between threshold speed and 100%"""
+    type = "exponential"
+
+    def validate(self):
+        for key in ("rate", "offset"):
+            if key in self.data and not is_number(self.data[key]):
+                raise ValueError("{} of an exponential curve has to be a number".format(key))
+        # the exponent is largest at one end of the score range
+        try:
+            speeds = [self.function(score, 0) for score in (0, 3)]
+        except OverflowError:
+            speeds = [math.inf]
+        if not all(math.isfinite(speed) for speed in speeds):
+            raise ValueError("rate {} and offset {} of an exponential curve overflow".format(
+                self.data.get("rate", 0.046), self.data.get("offset", 10)))
+
+    def function(self, score, threshold_speed):
+        rate = self.data.get("rate", 0.046)
+        offset = self.data.get("offset", 10)
+        return math.e ** (rate * (100 * (score - 2) + offset)) * ((100 - threshold_speed) / 100) + threshold_speed
+
+
+class LinearCurve(Curve):
+    """piecewise linear curve through points [[score, speed in 0 - 100%], ...], constant outside the points"""
+    type = "linear"
+
+    def validate(self):
+        points = self.data.get("points", [[0, 0], [3, 100]])
+        if not isinstance(points, list) or not points:
+            raise ValueError("a linear curve needs at least one point")
+        for point in points:
+            if not isinstance(point, list) or len(point) != 2 or not all(is_number(value) for value in point):
+                raise ValueError("points of a linear curve have to be [score, speed] pairs, got {!r}".format(point))
+            if not 0 <= point[1] <= 100:
+                raise ValueError("speeds of a linear curve have to be between 0 and 100%, got {!r}".format(point))
+
+    def function(self, score, threshold_speed):
+        points = sorted(self.data.get("points", [[0, 0], [3, 100]]))
+        if score <= points[0][0]:
+            return points[0][1]
+        for (x0, y0), (x1, y1) in zip(points, points[1:]):
+            if score <= x1:
+                return y0 + (y1 - y0) * (score - x0) / (x1 - x0) if x1 != x0 else y1
+        return points[-1][1]
+
+
+CURVES = {c.type: c for c in (ExponentialCurve, LinearCurve)}
+
+
+def load_curve(data, threshold_speed=0):
+    """returns compiled curve described by data, the default exponential curve if data is None. raises
+    ValueError if data is invalid"""
+    if data is None:
+        return ExponentialCurve().compile(threshold_speed)
+    if not isinstance(data, dict):
+        raise ValueError("a curve has to be an object")
+    curve_type = data.get("type", "exponential")
+    if curve_type not in CURVES:
+        raise ValueError("unknown curve type {!r}, expected one of {}".format(curve_type, ", ".join(CURVES)))
+    return CURVES[curve_type](data).compile(threshold_speed)
+
+
+class ScoreTable:
+    """score of a thermal zone (0 - idle - desired - critical => 0 - 1 - 2 - 3) over 1°C bins
+
+    with integer thresholds the score is linear between bins, so interpolating the table is exact"""
+
+    def __init__(self, idle, desired, critical):
+        self.idle = idle
+        self.desired = desired
+        self.critical = critical
+        self.table = LookupTable(self.function, 0, max(int(math.ceil(critical)), 1), 1)
+
+    def function(self, temp):
+        if temp < self.idle:
+            return 0 + temp/self.idle
+        elif temp < self.desired:
+            return 1 + (temp-self.idle)/(self.desired - self.idle)
+        elif temp < self.critical:
+            return 2 + (temp-self.desired)/(self.critical - self.desired)
+        return 3
+
+    def __call__(self, temp):
+        if temp >= self.critical:
+            return 3
+        if temp < 0:
+            return temp/self.idle
+        return self.table(temp)
@@ -1,8 +1,9 @@
 from hwmon import get_all_hwmons
-from thermal_zone import ThermalZone, ThermalCpu, ThermalGpu
+from thermal_zone import ThermalZone, ThermalCpu, ThermalGpu, group_cpu_packages
 from time import sleep
 import os
 from cli import color, print_table, printl, sleep_print
+from characterization import Characterizer
 
 
 def _detect_thermal_zones(control, hwmons):
@@ -30,7 +31,7 @@ def _detect_thermal_zones(control, hwmons):
     thermal_zones = []
 
     # adding all thermazones to thermal_zones list
-    # creating thermalgroups (CPU, GPU)
+    # creating thermalgroups (one CPU per physical package, GPU)
     for hwmon in hwmons:
         for thermal_zone in hwmon.thermal_zones:
             thermal_zones.append(thermal_zone)
@@ -39,9 +40,7 @@ def _detect_thermal_zones(control, hwmons):
             thermal_gpu = ThermalGpu(control.thermal_manager).from_hwmon(hwmon.thermal_zones[0].base_path, hwmon)
             thermal_zones.append(thermal_gpu)
 
-        if hwmon.type == "CPU":
-            thermal_cpu = ThermalCpu(control.thermal_manager).from_hwmon("", hwmon)
-            thermal_zones.append(thermal_cpu)
+    thermal_zones.extend(group_cpu_packages(control.thermal_manager, hwmons))
 
     print(color("Found following thermal zones:", "bold"))
     thermal_zones = sorted(thermal_zones, key=lambda x: x.full_name)
@@ -50,107 +49,221 @@ def _detect_thermal_zones(control, hwmons):
     return thermal_zones
 
 
-def _detect_cooling_device_threshold(device):
-    printl("Getting fan started: ")
+def _detect_cooling_device_threshold(device, ask=input, out=None):
+    printl("Getting fan started: ", file=out)
     device.set_speed(100)
-    success = device.wait_for_fan_response(response=(lambda d: d.rpm > 0), p=True)
+    success = device.wait_for_fan_response(response=(lambda d: d.rpm > 0), p=True, out=out)
     if not success:
-        print(color(" ERROR: Device unavailable", "fail"))
+        print(color(" ERROR: Device unavailable", "fail"), file=out)
         return False
 
-    print(color(" OK", "green"))
+    print(color(" OK", "green"), file=out)
 
-    printl("Stopping fan: ")
+    printl("Stopping fan: ", file=out)
     device.set_speed(0)
 
-    success = device.wait_for_fan_response(response=(lambda d: d.rpm == 0), p=True, timeout=10)
-    if not success:
-        print(" Unable to stop fan")
+    stoppable = device.wait_for_fan_response(response=(lambda d: d.rpm == 0), p=True, out=out, timeout=10,
+                                             budget=6)
+    if not stoppable:
+        print(" Unable to stop fan", file=out)
         device.threshold_speed = 0
 
-        user_in = input("Is the fan actually a pump? [yes|NO]: ").lower().strip()
+        user_in = ask("Is the fan actually a pump? [yes|NO]: ").lower().strip()
         if user_in in ["yes", "y"]:
             device.is_pump = True
         else:
             device.is_pump = False
 
     if not device.is_pump:
-        sleep_print(6)
-        print(color(" OK", "green"))
-
-    data = [device.rpm]
-    threshold_found = False
-
-    printl("Slowly ramping up fan: ")
-    device.set_speed(8)
-
-    while device.speed < 100:
-        cur_speed = device.speed
-        if not threshold_found:
-            cur_speed += 2
-            device.set_speed(cur_speed)
-            sleep_print(3)
-            if device.rpm > 0:
-                threshold_found = True
-                device.threshold_speed = cur_speed + 2
-                device.set_speed(cur_speed - cur_speed % 10)
-                sleep_print(3)
-
-        else:
-            device.set_speed(cur_speed + 10)
-            sleep_print(5)
-
-        if cur_speed % 10 == 0:
-            data.append(device.rpm)
-
-    print(color(" OK", "green"))
-    device.rpm_curve = data
-    print(data)
+        print(color(" OK", "green"), file=out)
+
+    detector = device.settle_detector
+    spent = detector.spent
+    steps = 0
+
+    low = 0
+    if stoppable:
+        printl("Searching threshold speed: ", file=out)
+        low, high, steps = _search_threshold_speed(device, out=out)
+        device.threshold_speed = min(high + 2, 100)
+        print(color(" OK", "green"), "(" + str(high) + "%)", file=out)
+
+    printl("Sampling rpm curve: ", file=out)
+    points, curve_steps = _sample_rpm_curve(device, device.threshold_speed, out=out)
+    if stoppable:
+        # below the threshold a fan starting from standstill does not spin
+        points[:0] = [[0, 0, 1.0]] + ([[low, 0, 1.0]] if low > 0 else [])
+    print(color(" OK", "green"), file=out)
+
+    device.rpm_points = points
+    device.rpm_curve = [int(round(device.fan_model.rpm(10 * i))) for i in range(11)]
+
+    # the former 2% ramp waited 3s per step up to the threshold and 5s per 10% step above
+    threshold = device.threshold_speed
+    budget = max(threshold - 8, 0) / 2 * 3 + 3 + (100 - (threshold - threshold % 10)) / 10 * 5
+    detector.saved += budget - (detector.spent - spent)
+    print("Measured {} points in {} steps: {}".format(len(points), steps + curve_steps,
+                                                      [(speed, rpm) for speed, rpm, _ in points]), file=out)
     return True
 
 
-def _check_cooling_device_threshold(device):
-        printl("Checking threshold speed: ")
+def _search_threshold_speed(device, resolution=2, out=None):
+    """bisects the lowest speed in % at which the fan starts spinning
+
+    fans start at a higher speed than the one they stop at (hysteresis), so every probe starts from a
+    complete standstill. returns highest speed not starting the fan, lowest speed starting it and the
+    number of probes"""
+    low, high = 0, 100
+    steps = 0
+    while high - low > resolution:
+        speed = (low + high) // 2
+        device.set_speed(0)
+        device.wait_for_fan_response(response=(lambda d: d.rpm == 0), timeout=20, window=2, p=True, out=out)
+        device.set_speed(speed)
+        # slow starting fans need a moment, a longer window keeps a late start from being missed
+        device.wait_for_steady_rpm(timeout=8, window=3, p=True, out=out)
+        if device.rpm > 0:
+            high = speed
+        else:
+            low = speed
+        steps += 1
+    return low, high, steps
+
+
+def _measure_rpm(device, speed, out=None):
+    """returns [speed, rpm, confidence] measured after the fan settled at speed"""
+    device.set_speed(speed)
+    device.wait_for_steady_rpm(timeout=10, p=True, out=out)
+    detector = device.settle_detector
+    return [speed, int(round(detector.value or 0)), round(detector.confidence, 2)]
+
+
+def _sample_rpm_curve(device, start, tolerance=0.015, min_step=5, coarse=4, out=None):
+    """samples the rpm curve between start and 100% on a coarse grid, then bisects every interval whose
+    midpoint deviates more than tolerance * max rpm from the straight line, i.e. where the curve bends.
+
+    a single reading may be off, so a midpoint off the line is measured again and the interval is only split on
+    the average of both. points below the rpm of a lower speed (or a midpoint above the rpm of its upper end)
+    are measurement errors and rejected. returns sorted [speed, rpm, confidence] points and the number of
+    measurements"""
+    speeds = sorted(set(int(round(start + (100 - start) * i / coarse)) for i in range(coarse + 1)))
+    points = {speed: _measure_rpm(device, speed, out) for speed in speeds}
+    steps = len(points)
+    highest = 0
+    for speed in speeds[:-1]:
+        if highest <= points[speed][1] <= points[speeds[-1]][1]:
+            highest = points[speed][1]
+        else:
+            del points[speed]
+    speeds = sorted(points)
+    max_rpm = max(max(point[1] for point in points.values()), 1)
+
+    intervals = list(zip(speeds, speeds[1:]))
+    while intervals:
+        a, b = intervals.pop()
+        if b - a < 2 * min_step:
+            continue
+        middle = (a + b) // 2
+        low, high = points[a][1], points[b][1]
+        linear = low + (high - low) * (middle - a) / (b - a)
+        point = _measure_rpm(device, middle, out)
+        steps += 1
+        if abs(point[1] - linear) > tolerance * max_rpm or not low <= point[1] <= high:
+            again = _measure_rpm(device, middle, out)
+            steps += 1
+            point = [middle, int(round((point[1] + again[1]) / 2)), round((point[2] + again[2]) / 2, 2)]
+            if not low <= point[1] <= high:
+                continue
+        points[middle] = point
+        if abs(point[1] - linear) > tolerance * max_rpm:
+            intervals.extend([(a, middle), (middle, b)])
+
+    return [points[speed] for speed in sorted(points)], steps
+
+
+def _check_cooling_device_threshold(device, out=None):
+        printl("Checking threshold speed: ", file=out)
 
         device.set_speed(0)
-        success = device.wait_for_fan_response(response=(lambda d: d.rpm == 0), p=True)
+        # the fan has to be at a complete stop, so the standstill has to hold for a few seconds
+        success = device.wait_for_fan_response(response=(lambda d: d.rpm == 0), p=True, out=out, timeout=20,
+                                                 window=4, budget=12)
         if not success:
-            print(" ERROR: Could not stop fan")
+            print(" ERROR: Could not stop fan", file=out)
             return False
 
-        sleep_print(12)
-
         device.set_speed(device.threshold_speed)
-        success = device.wait_for_fan_response(response=(lambda d: d.rpm > 0), p=True)
+        success = device.wait_for_fan_response(response=(lambda d: d.rpm > 0), p=True, out=out)
         if success:
-            print(" OK")
+            print(" OK", file=out)
         else:
-            print(" ERROR: Could not start fan")
+            print(" ERROR: Could not start fan", file=out)
             return False
         return True
 
 
-def _detect_cooling_device_speeds(device):
+def print_settle_time(device, out=None):
+    detector = device.settle_detector
+    print("Waited {}s for the fan to settle, {}s {} than with fixed delays".format(
+        round(detector.spent, 1), round(abs(detector.saved), 1), "less" if detector.saved >= 0 else "more"),
+        file=out)
+
+
+def _detect_cooling_device_speeds(device, ask=input, out=None):
     old_speed = device.speed
-    print("\nDetecting max & threshold speed of device " + device.name + " (" + str(device.index) + ")")
+    print("\nDetecting max & threshold speed of device " + device.name + " (" + str(device.index) + ")",
+          file=out)
 
-    success = _detect_cooling_device_threshold(device)
+    success = _detect_cooling_device_threshold(device, ask=ask, out=out)
     if not success:
         return False
     elif device.is_pump:
-        print("Success! Detected: \n\t\tmax-speed: " + str(device.max_speed) + "rpm\n\t\tis pump:    yes")
+        print("Success! Detected: \n\t\tmax-speed: " + str(device.max_speed) + "rpm\n\t\tis pump:    yes",
+              file=out)
+        print_settle_time(device, out)
         return True
 
-    success = _check_cooling_device_threshold(device)
+    success = _check_cooling_device_threshold(device, out)
     if not success:
         return False
 
     print("Success! Detected: \n\t\tmax-speed: " + str(device.max_speed) + "rpm\n\t\tthreshold: " + str(
-        device.threshold_speed) + "%")
+        device.threshold_speed) + "%", file=out)
+    print_settle_time(device, out)
     device.set_speed(old_speed)
     return success
 
 
+def _detect_all_cooling_device_speeds(devices):
+    """detects threshold speeds and rpm curves, devices on different chips in parallel"""
+    print(color("\nDetecting max & threshold speeds, devices on different chips in parallel...", "bold"))
+    unstoppable = []
+
+    def detect_speeds(device, out):
+        # user input is not possible while running in parallel, questions are asked afterwards
+        def ask_pump(question):
+            unstoppable.append(device)
+            return "yes"
+        return _detect_cooling_device_speeds(device, ask=ask_pump, out=out)
+
+    characterizer = Characterizer(devices)
+    characterizer.run(detect_speeds)
+    print("Characterized " + characterizer.summary())
+
+    # a fan that is no pump has its threshold checked, which the parallel run skipped for the assumed pump
+    fans = []
+    for device in unstoppable:
+        user_in = input("Device " + device.name + " could not be stopped. Is the fan actually a pump? [yes|NO]: ")
+        if user_in.lower().strip() not in ["yes", "y"]:
+            fans.append(device)
+    if fans:
+        print(color("\nDetecting the threshold speeds of the fans again...", "bold"))
+
+        def detect_fan_speeds(device, out):
+            return _detect_cooling_device_speeds(device, ask=lambda question: "no", out=out)
+        Characterizer(fans).run(detect_fan_speeds)
+
+
 def _detect_cooling_devices(control, hwmons):
     """allow user to detect and name relevant CoolingDevices"""
 
@@ -170,17 +283,13 @@ def _detect_cooling_devices(control, hwmons):
     cooling_devices = []
 
     print(color("Attempting to filter out non existent cooling devices...", "bold"))
-    # filter out every cooling device which ist not connected
+    # filter out every cooling device which ist not connected, chips are probed in parallel
+    characterizer = Characterizer([device for hwmon in hwmons for device in hwmon.cooling_devices])
+    exists = characterizer.run(lambda device, out: device.test_exists())
     for hwmon in hwmons:
-        if len(hwmon.cooling_devices) == 0:
-            continue
-        i = 0
-        while i < (len(hwmon.cooling_devices)):
-            if hwmon.cooling_devices[i].test_exists():
-                cooling_devices.append(hwmon.cooling_devices[i])
-                i += 1
-            else:
-                del hwmon.cooling_devices[i]
+        hwmon.cooling_devices = [device for device in hwmon.cooling_devices if exists[device]]
+        cooling_devices.extend(hwmon.cooling_devices)
+    print("Probed " + characterizer.summary())
 
     print(color("\nRemaining cooling devices:\n", "bold"))
     # print all remaining cooling devices
@@ -188,6 +297,7 @@ def _detect_cooling_devices(control, hwmons):
                                            for device in cooling_devices])
 
     detect_threshold_mode = None
+    detect_devices = []
 
     print(color("\nWe will now start the process of identifying and naming your cooling devices.\n"
                 "They will be ramping up and down one by one.", "bold"))
@@ -204,7 +314,7 @@ def _detect_cooling_devices(control, hwmons):
             else:
                 device2.set_speed(0)
 
-        sleep(3)
+        device.wait_for_steady_rpm(budget=3, timeout=6)
         user = input("Enter new name for cooling device>")
         skipped = False
         if len(user) > 0:
@@ -231,7 +341,7 @@ def _detect_cooling_devices(control, hwmons):
                 detect_threshold = detect_threshold_mode
 
             if detect_threshold:
-                _detect_cooling_device_speeds(device)
+                detect_devices.append(device)
 
         device.set_speed(50)
         print("Briefly restoring temperatures")
@@ -240,6 +350,14 @@ def _detect_cooling_devices(control, hwmons):
     for device in cooling_devices:
         device.set_speed(50)
 
+    if len(detect_devices) > 0:
+        _detect_all_cooling_device_speeds(detect_devices)
+
+    print(color("\nTime saved by settle detection:", "bold"))
+    print_table(["name", "waited", "saved"], [[device.full_name, str(round(device.settle_detector.spent, 1)) + "s",
+                                               "{:+.1f}s".format(device.settle_detector.saved)]
+                                              for device in cooling_devices])
+
     print("Finished")
 
     return cooling_devices
@@ -0,0 +1,168 @@
+# coding=utf-8
+"""asyncio core of the fctrl daemon"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import Scheduler
+
+
+def group_by_chip(items, get_path):
+    """groups items by the directory (hwmon chip) of their sysfs path"""
+    groups = {}
+    for item in items:
+        groups.setdefault(os.path.dirname(get_path(item)), []).append(item)
+    return list(groups.values())
+
+
+class Engine:
+    """runs the control loop on an asyncio event loop
+
+    blocking sysfs reads and writes are dispatched to a bounded executor, one job per hwmon chip, so a slow chip
+    does not delay the others. additional coroutines (control socket, exporters, recorders) can be added with
+    add_task and run on the same loop, tick listeners are called after every control step. the control step and
+    other periodic jobs (add_periodic) run on the deadlines of a shared Scheduler."""
+
+    def __init__(self, control, interval=1, workers=4, scheduler=None):
+        self.control = control
+        self.scheduler = scheduler if scheduler is not None else Scheduler()
+        self.control_task = self.scheduler.add("control", self.step, interval)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fctrl-io")
+        self.tick = 0
+        self.__loop = None
+        self.__pending_tasks = []
+        self.__tasks = []
+        self.__listeners = []
+        self.__stopped = None
+        self.__wakeup = None
+
+    @property
+    def interval(self):
+        """returns period of the control step in seconds"""
+        return self.control_task.period
+
+    @interval.setter
+    def interval(self, value):
+        self.control_task.set_period(value)
+
+    @property
+    def missed_ticks(self):
+        """returns number of missed control step deadlines"""
+        return self.control_task.missed
+
+    @property
+    def loop(self):
+        """returns running event loop, None if not running"""
+        return self.__loop
+
+    def add_task(self, coro):
+        """runs coroutine coro alongside the control loop"""
+        if self.__loop is None:
+            self.__pending_tasks.append(coro)
+        else:
+            self.__tasks.append(self.__loop.create_task(coro))
+
+    def add_listener(self, listener):
+        """registers listener(engine, snapshot) called after every tick, may be a coroutine function"""
+        self.__listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """unregisters listener"""
+        self.__listeners.remove(listener)
+
+    def add_periodic(self, name, func, period, phase=0):
+        """runs func() (may be a coroutine function) every period seconds, phase seconds after the start"""
+        return self.scheduler.add(name, func, period, phase)
+
+    async def run_blocking(self, func, *args):
+        """runs blocking func(*args) in the io executor"""
+        return await self.__loop.run_in_executor(self.executor, func, *args)
+
+    async def sample(self):
+        """reads all sampled attributes, chips concurrently, and commits the new snapshot"""
+        sampler = self.control.sampler
+
+        def read_chip(attributes):
+            return [(attribute.path, attribute.read_int()) for attribute in attributes]
+
+        chips = group_by_chip(sampler.attributes, lambda a: a.path)
+        results = await asyncio.gather(*(self.run_blocking(read_chip, chip) for chip in chips))
+        return sampler.commit({path: value for chip in results for path, value in chip})
+
+    async def actuate(self, speeds):
+        """writes (device, speed) pairs, chips concurrently"""
+
+        def write_chip(chip):
+            for device, speed in chip:
+                device.set_speed(speed)
+
+        chips = group_by_chip(speeds, lambda item: item[0].base_path)
+        await asyncio.gather(*(self.run_blocking(write_chip, chip) for chip in chips))
+
+    async def step(self):
+        """runs one tick: sample, compute and write all devices"""
+        snapshot = await self.sample()
+        await self.actuate(self.control.cooling_manager.compute_speeds())
+        self.tick += 1
+
+        for listener in list(self.__listeners):
+            result = listener(self, snapshot)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def run(self):
+        """runs the control loop on fixed deadlines until stop is called"""
+        self.__loop = asyncio.get_running_loop()
+        self.__stopped = asyncio.Event()
+        self.__wakeup = asyncio.Event()
+        for coro in self.__pending_tasks:
+            self.add_task(coro)
+        self.__pending_tasks = []
+
+        scheduler = self.scheduler
+        scheduler.start()
+        try:
+            while not self.__stopped.is_set():
+                for task in scheduler.get_due():
+                    started = scheduler.clock()
+                    try:
+                        result = task.func()
+                        if asyncio.iscoroutine(result):
+                            await result
+                    except Exception:
+                        task.errors += 1
+                    scheduler.done(task, started)
+                    if self.__stopped.is_set():
+                        break
+
+                deadline = scheduler.next_deadline()
+                timeout = None if deadline is None else max(deadline - scheduler.clock(), 0) / scheduler.speed
+                try:
+                    await asyncio.wait_for(self.__wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.__wakeup.clear()
+        finally:
+            for task in self.__tasks:
+                task.cancel()
+            await asyncio.gather(*self.__tasks, return_exceptions=True)
+            self.__tasks = []
+            self.executor.shutdown(wait=False)
+            self.__loop = None
+
+    def wake(self, name="control"):
+        """runs periodic task name as soon as possible, has to be called from the event loop"""
+        self.scheduler.trigger(name)
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+
+    def wake_threadsafe(self, name="control"):
+        """wake for other threads (e.g. the alarm watcher)"""
+        loop = self.__loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self.wake, name)
+
+    def stop(self):
+        """stops the control loop after the current tick"""
+        if self.__stopped is not None:
+            self.__stopped.set()
+            self.__wakeup.set()
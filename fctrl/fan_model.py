@@ -0,0 +1,90 @@
+# coding=utf-8
+"""rpm <-> pwm model of a fan, built from its detected rpm curve"""
+from bisect import bisect_left, bisect_right
+
+
+def points_from_rpm_curve(rpm_curve):
+    """returns (speed in %, rpm) points of an rpm_curve measured in 10% steps"""
+    return [(10 * i, rpm) for i, rpm in enumerate(rpm_curve) if rpm is not None]
+
+
+class FanModel:
+    """monotone piecewise linear interpolant through measured (speed in %, rpm) points
+
+    measurement noise (e.g. a pump reading 4485 then 4470 rpm) is removed by a running maximum, so
+    forward (speed -> rpm) and inverse (rpm -> speed) queries are a single bisection each."""
+
+    def __init__(self, points):
+        points = sorted(points)
+        self.speeds = [float(speed) for speed, _ in points]
+        self.rpms = []
+        highest = 0
+        for _, rpm in points:
+            highest = max(highest, rpm)
+            self.rpms.append(highest)
+
+    @classmethod
+    def from_rpm_curve(cls, rpm_curve, rpm_points=None):
+        """returns model of rpm_curve, finer rpm_points [[speed, rpm, ...], ...] take precedence if given"""
+        if rpm_points:
+            return cls([(point[0], point[1]) for point in rpm_points])
+        return cls(points_from_rpm_curve(rpm_curve))
+
+    def __len__(self):
+        return len(self.speeds)
+
+    @property
+    def max_rpm(self):
+        return self.rpms[-1] if self.rpms else 0
+
+    def rpm(self, speed):
+        """returns expected rpm at speed in %, None if model is empty"""
+        if not self.speeds:
+            return None
+        index = bisect_right(self.speeds, speed)
+        if index == 0:
+            return self.rpms[0]
+        if index == len(self.speeds):
+            return self.rpms[-1]
+        s0, s1 = self.speeds[index - 1], self.speeds[index]
+        r0, r1 = self.rpms[index - 1], self.rpms[index]
+        return r0 + (r1 - r0) * (speed - s0) / (s1 - s0)
+
+    def speed(self, rpm):
+        """returns (lowest, highest) speed in % producing rpm, None if rpm is outside of the model
+
+        the range is wider than a point where the curve is flat, e.g. every speed below the threshold for rpm 0.
+        a reading above a model measured up to 100% is full speed, the tach noise spreads it around the maximum"""
+        rpms = self.rpms
+        if not rpms or rpm is None or rpm < rpms[0]:
+            return None
+        if rpm > rpms[-1]:
+            return (self.speeds[-1], self.speeds[-1]) if self.speeds[-1] >= 100 else None
+
+        low = bisect_left(rpms, rpm)
+        high = bisect_right(rpms, rpm)
+        if low < high:
+            return self.speeds[low], self.speeds[high - 1]
+
+        s0, s1 = self.speeds[low - 1], self.speeds[low]
+        r0, r1 = rpms[low - 1], rpms[low]
+        speed = s0 + (s1 - s0) * (rpm - r0) / (r1 - r0)
+        return speed, speed
+
+
+def speed_ranges(models, rpms):
+    """returns speed range of every (model, rpm) pair, see FanModel.speed"""
+    return [model.speed(rpm) for model, rpm in zip(models, rpms)]
+
+
+def check_responsive(models, rpms, speeds, accuracy=2):
+    """returns for every device whether its commanded speed in % matches its measured rpm within accuracy"""
+    result = []
+    for speed_range, speed in zip(speed_ranges(models, rpms), speeds):
+        if speed_range is None:
+            low = high = 0
+        else:
+            low = min(max(speed_range[0] - accuracy, 0), 100)
+            high = min(max(speed_range[1] + accuracy, 0), 100)
+        result.append(low <= speed <= high)
+    return result
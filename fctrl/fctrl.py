@@ -3,6 +3,11 @@
 
 from thermal_manager import ThermalManager
 from cooling_manager import CoolingManager
+from sampler import Sampler
+from polling import AdaptiveInterval
+from config import write_atomic
+from control_client import SOCKET_PATH
+from telemetry import telemetry
 
 import json
 from time import sleep
@@ -21,14 +26,24 @@ def lerp(a, b, alpha):
 class FanControl:
     """central object, manages thermals, fans, fancurves"""
     config_path = "/etc/fctrl/.config"
+    socket_path = SOCKET_PATH
+    recorder_path = "/var/lib/fctrl/flight.rec"
 
-    def __init__(self):
-        data = self.load()
+    def __init__(self, data=None):
+        """loads data (see save), the config file if None"""
+        if data is None:
+            data = self.load()
 
         cooling_data, thermal_data = None, None
         if data is not None:
             cooling_data, thermal_data = data["cooling"], data["thermal"]
-        self.__thermal_manager = ThermalManager(thermal_data)
+        self.__polling = AdaptiveInterval(data.get("polling") if data is not None else None)
+        self.__alarm_data = data.get("alarms", {}) if data is not None else {}
+        telemetry.configure(data.get("telemetry") if data is not None else None)
+        self.__recorder_data = data.get("recorder", {}) if data is not None else {}
+        self.__sampler = Sampler()
+        self.__sampler.base_interval = self.__polling.base_interval
+        self.__thermal_manager = ThermalManager(thermal_data, self.__sampler)
         self.__cooling_manager = CoolingManager(self, cooling_data)
 
         # print(color("\n\n====LOAD SUMMARY====", "bold", "header"))
@@ -40,6 +55,64 @@ class FanControl:
 
         self.__curves = []
 
+    def apply_json(self, data):
+        """applies data (see save) to the live zones and devices, keeps the controller state
+
+        zones and devices are built and validated first, an invalid config raises before anything is applied"""
+        zones, commit_thermal = self.thermal_manager.prepare_json(data["thermal"])
+        commit_cooling = self.cooling_manager.prepare_json(data["cooling"], zones)
+        commit_thermal()
+        commit_cooling()
+        self.polling.load_json(data.get("polling"))
+        self.sampler.base_interval = self.polling.base_interval
+        self.__alarm_data = data.get("alarms", {})
+        telemetry.configure(data.get("telemetry"))
+
+    def reload(self):
+        """re-reads the config file and applies it, returns False if it could not be loaded"""
+        data = self.load()
+        if data is None:
+            return False
+        self.apply_json(data)
+        return True
+
+    async def watch_config(self, engine, interval=2):
+        """reloads the config whenever it changes and runs a control step right away
+
+        waits on inotify if available, checks the file every interval seconds otherwise"""
+        import asyncio
+        from config import ConfigWatcher
+        watcher = ConfigWatcher(self.config_path)
+        changed = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        if watcher.fileno() is not None:
+            loop.add_reader(watcher.fileno(), changed.set)
+        try:
+            while True:
+                if watcher.fileno() is not None:
+                    await changed.wait()
+                    changed.clear()
+                else:
+                    await asyncio.sleep(interval)
+                if not watcher.changed():
+                    continue
+                try:
+                    reloaded = self.reload()
+                except Exception as e:
+                    # keep running on the old config, the next change is picked up again
+                    telemetry.event("config-reload-failed", "error", path=self.config_path, error=repr(e))
+                    continue
+                if reloaded:
+                    telemetry.event("config-reloaded", "info", path=self.config_path)
+                    engine.wake()
+                else:
+                    telemetry.event("config-reload-failed", "error", path=self.config_path,
+                                    error="config could not be read")
+        finally:
+            if watcher.fileno() is not None:
+                loop.remove_reader(watcher.fileno())
+            watcher.close()
+
     def load(self):
         """load from file"""
         try:
@@ -53,6 +126,16 @@ class FanControl:
 
         return data
 
+    @property
+    def sampler(self):
+        """returns sampler providing the per tick sensor snapshot"""
+        return self.__sampler
+
+    @property
+    def polling(self):
+        """returns adaptive control interval"""
+        return self.__polling
+
     @property
     def thermal_manager(self):
         """returns thermal manager"""
@@ -63,29 +146,77 @@ class FanControl:
         """returns cooling manager"""
         return self.__cooling_manager
 
-    def save(self):
-        """saves to file"""
+    def get_json(self):
+        """return data as dict for json (see save)"""
         data = dict()
         data["cooling"] = self.cooling_manager.get_json()
         data["thermal"] = self.thermal_manager.get_json()
-        data = json.dumps(data)
+        data["polling"] = self.polling.get_json()
+        data["alarms"] = self.__alarm_data
+        data["telemetry"] = telemetry.get_json()
+        data["recorder"] = self.__recorder_data
+        return data
+
+    def save(self):
+        """saves to file"""
+        data = json.dumps(self.get_json())
 
         with open(".config-backup", "w+") as file:
             file.write(data)
 
         with suppress(FileExistsError):
             os.makedirs(os.path.dirname(self.config_path))
-        with open(self.config_path, "w+") as file:
-            file.write(data)
-
-    def run(self):
-        """starts fancontrol"""
-        while True:
-            try:
-                self.cooling_manager.update_devices()
-            except:
-                pass
-            sleep(1)
+        # the running daemon reloads the config on change, it must never see a partial file
+        write_atomic(self.config_path, data)
+
+    def setup_services(self, engine):
+        """adds the daemon services to engine: adaptive interval, config reload, control socket and flight
+        recorder. returns the recorder, None if it is disabled or could not be opened"""
+        from control_socket import ControlServer
+        from recorder import FlightRecorder
+        engine.add_listener(self.polling)
+        engine.add_task(self.watch_config(engine))
+        engine.add_task(ControlServer(self, engine, self.socket_path).serve())
+
+        if not self.__recorder_data.get("enabled", True):
+            return None
+        recorder = FlightRecorder(self.__recorder_data.get("path", self.recorder_path),
+                                  self.__recorder_data.get("capacity", 86400))
+        try:
+            recorder.open(self.thermal_manager.thermal_zones, self.cooling_manager.cooling_devices)
+        except OSError as e:
+            telemetry.event("recorder-failed", "warning", path=recorder.path, error=str(e))
+            return None
+        engine.add_listener(recorder)
+        return recorder
+
+    def run(self, engine=None):
+        """starts fancontrol on engine (a new one on the polling interval if None) with all daemon services"""
+        # the event loop and its services are only needed by the daemon, not by cli queries
+        import asyncio
+        from engine import Engine
+        from alarms import AlarmWatcher
+        if engine is None:
+            engine = Engine(self, interval=self.polling.base_interval)
+        recorder = self.setup_services(engine)
+
+        watcher = None
+        if self.__alarm_data.get("enabled", False):
+            # event driven mode: hardware alarms trigger an immediate control step
+            watcher = AlarmWatcher(self.thermal_manager, lambda paths: engine.wake_threadsafe(),
+                                   self.__alarm_data.get("fallback-interval", 0.5),
+                                   self.__alarm_data.get("program-limits", True),
+                                   self.__alarm_data.get("notify-chips"))
+            watcher.start()
+            # re-arms the watcher once a reload or the socket changed zones or thresholds
+            engine.add_listener(watcher)
+        try:
+            asyncio.run(engine.run())
+        finally:
+            if watcher is not None:
+                watcher.stop()
+            if recorder is not None:
+                recorder.close()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,10 @@
+import errno
+import os
+from time import monotonic
+
+# errors after which a sysfs handle is stale and has to be reopened (e.g. driver reload)
+REOPEN_ERRNOS = (errno.ENODEV, errno.ESTALE, errno.EBADF)
+
 
 def read_all(path):
     """read full file (non binary)"""
@@ -17,3 +24,142 @@ def write(path, content):
     except (FileNotFoundError, OSError):
         return False
     return True
+
+
+class SysfsAttribute:
+    """persistent handle to a single sysfs attribute (e.g. temp1_input, pwm1)
+
+    the file is opened once and re-read with os.pread at offset 0, so a tick costs one syscall per attribute
+    instead of open/read/close. stale handles (ENODEV/ESTALE) are reopened transparently."""
+
+    read_size = 32
+
+    def __init__(self, path):
+        self.path = path
+        # sysfs ignores offset and length of a write, regular files (tests, simulation) have to be truncated
+        self.__truncate = not path.startswith("/sys/")
+        self.__read_fd = None
+        self.__write_fd = None
+
+    def __repr__(self):
+        return "SysfsAttribute(" + self.path + ")"
+
+    def close(self):
+        """closes all open file descriptors"""
+        for fd in (self.__read_fd, self.__write_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self.__read_fd = self.__write_fd = None
+
+    def read(self):
+        """returns raw content as bytes, None if unavailable"""
+        for retry in (False, True):
+            try:
+                if self.__read_fd is None:
+                    self.__read_fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+                return os.pread(self.__read_fd, self.read_size, 0)
+            except OSError as e:
+                self.close()
+                if retry or e.errno not in REOPEN_ERRNOS:
+                    return None
+        return None
+
+    def read_int(self):
+        """returns content as int, None if unavailable"""
+        content = self.read()
+        try:
+            return int(content)
+        except (ValueError, TypeError):
+            return None
+
+    def write(self, content):
+        """writes content at offset 0, returns success (same semantics as file_ops.write)"""
+        data = str(content).encode()
+        for retry in (False, True):
+            try:
+                if self.__write_fd is None:
+                    self.__write_fd = os.open(self.path, os.O_WRONLY | os.O_CLOEXEC)
+                os.pwrite(self.__write_fd, data, 0)
+                if self.__truncate:
+                    os.ftruncate(self.__write_fd, len(data))
+                return True
+            except PermissionError:
+                import __main__
+                print("insufficent permission", self.path, content, __main__.__file__)
+                raise
+            except OSError as e:
+                self.close()
+                if retry or e.errno not in REOPEN_ERRNOS:
+                    return False
+        return False
+
+
+class ShadowRegister:
+    """write-back layer for a pwm channel: remembers the last committed value and suppresses writes that are
+    identical or inside the deadband. a forced refresh every refresh_interval seconds corrects BIOS/EC drift."""
+
+    def __init__(self, attribute, deadband=0, refresh_interval=30, minimum=0, maximum=255):
+        self.attribute = attribute
+        self.deadband = deadband
+        self.refresh_interval = refresh_interval
+        self.minimum = minimum
+        self.maximum = maximum
+        self.value = None
+        self.written = 0
+        self.suppressed = 0
+        self.__last_write = 0
+
+    def invalidate(self):
+        """forgets the committed value, next write goes through"""
+        self.value = None
+
+    def is_redundant(self, value):
+        """returns whether writing value can be skipped"""
+        if self.value is None or monotonic() - self.__last_write >= self.refresh_interval:
+            return False
+        if value == self.value:
+            return True
+        # never hold a channel just off its limits (e.g. a fan that should stop)
+        if value in (self.minimum, self.maximum):
+            return False
+        return abs(value - self.value) <= self.deadband
+
+    def write(self, value):
+        """writes value unless redundant, returns success"""
+        if self.is_redundant(value):
+            self.suppressed += 1
+            return True
+
+        success = self.attribute.write(value)
+        if success:
+            self.value = value
+            self.__last_write = monotonic()
+            self.written += 1
+        else:
+            self.value = None
+        return success
+
+    def get_stats(self):
+        """returns write counters as dict"""
+        return {"written": self.written, "suppressed": self.suppressed}
+
+
+__attributes = {}
+
+
+def get_attribute(path):
+    """returns the shared SysfsAttribute handle for path (one handle per path and process)"""
+    try:
+        return __attributes[path]
+    except KeyError:
+        attribute = __attributes[path] = SysfsAttribute(path)
+        return attribute
+
+
+def close_all():
+    """closes all shared sysfs handles"""
+    for attribute in __attributes.values():
+        attribute.close()
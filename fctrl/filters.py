@@ -0,0 +1,169 @@
+# coding=utf-8
+"""sensor filters working on millidegree readings, configured per thermal zone
+
+filters are tuned per base interval, update gets the length of the tick in base intervals as scale
+(see Sampler.get_time_scale). window based filters count readings."""
+
+
+class RingBuffer:
+    """fixed size buffer, push is O(1)"""
+
+    def __init__(self, size):
+        self.size = max(int(size), 1)
+        self.__data = []
+        self.__index = 0
+
+    def __len__(self):
+        return len(self.__data)
+
+    def push(self, value):
+        if len(self.__data) < self.size:
+            self.__data.append(value)
+        else:
+            self.__data[self.__index] = value
+        self.__index = (self.__index + 1) % self.size
+
+    def values(self):
+        """returns buffered values (unordered)"""
+        return self.__data
+
+
+def scale_alpha(alpha, scale):
+    """returns smoothing factor applying alpha per base interval to a tick of scale base intervals"""
+    if scale == 1:
+        return alpha
+    return 1 - (1 - alpha) ** scale
+
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2
+
+
+class Filter:
+    """base class of all filters, update takes a raw value and returns the filtered value"""
+    type = ""
+
+    def __init__(self, data=None):
+        self.data = dict(data) if data is not None else {"type": self.type}
+
+    def update(self, value, scale=1):
+        return value
+
+    def get_json(self):
+        """return data as dict for json"""
+        return self.data
+
+
+class MedianFilter(Filter):
+    """median of the last window readings"""
+    type = "median"
+
+    def __init__(self, data=None):
+        super().__init__(data)
+        self.buffer = RingBuffer(self.data.get("window", 3))
+
+    def update(self, value, scale=1):
+        self.buffer.push(value)
+        return median(self.buffer.values())
+
+
+class HampelFilter(Filter):
+    """replaces readings deviating more than threshold * MAD from the window median by the median
+
+    min-deviation (millidegrees) keeps a flat history (MAD of 0) from rejecting sensor noise."""
+    type = "hampel"
+
+    def __init__(self, data=None):
+        super().__init__(data)
+        self.buffer = RingBuffer(self.data.get("window", 5))
+        self.threshold = self.data.get("threshold", 3)
+        self.min_deviation = self.data.get("min-deviation", 2000)
+
+    def update(self, value, scale=1):
+        self.buffer.push(value)
+        values = self.buffer.values()
+        if len(values) < 3:
+            return value
+
+        center = median(values)
+        mad = 1.4826 * median([abs(x - center) for x in values])
+        if abs(value - center) > max(self.threshold * mad, self.min_deviation):
+            return center
+        return value
+
+
+class EmaFilter(Filter):
+    """exponential moving average"""
+    type = "ema"
+
+    def __init__(self, data=None):
+        super().__init__(data)
+        self.alpha = self.data.get("alpha", 0.5)
+        self.value = None
+
+    def update(self, value, scale=1):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += scale_alpha(self.alpha, scale) * (value - self.value)
+        return self.value
+
+
+class KalmanFilter(Filter):
+    """one dimensional kalman filter with constant temperature model
+
+    process-noise (per base interval) and measurement-noise are variances in millidegrees²"""
+    type = "kalman"
+
+    def __init__(self, data=None):
+        super().__init__(data)
+        self.process_noise = self.data.get("process-noise", 1e5)
+        self.measurement_noise = self.data.get("measurement-noise", 1e6)
+        self.value = None
+        self.error = 0
+
+    def update(self, value, scale=1):
+        if self.value is None:
+            self.value = value
+            self.error = self.measurement_noise
+            return self.value
+
+        self.error += self.process_noise * scale
+        gain = self.error / (self.error + self.measurement_noise)
+        self.value += gain * (value - self.value)
+        self.error *= 1 - gain
+        return self.value
+
+
+FILTERS = {f.type: f for f in (MedianFilter, HampelFilter, EmaFilter, KalmanFilter)}
+
+
+def load_filter(data):
+    """returns filter described by data, raises ValueError if its type is unknown"""
+    filter_type = data.get("type") if isinstance(data, dict) else None
+    if filter_type not in FILTERS:
+        raise ValueError("unknown filter {!r}, expected a type of {}".format(data, ", ".join(FILTERS)))
+    return FILTERS[filter_type](data)
+
+
+class FilterChain:
+    """applies filters in order, the whole chain fails to load if one filter is invalid"""
+
+    def __init__(self, data):
+        self.filters = [load_filter(d) for d in data]
+
+    def __len__(self):
+        return len(self.filters)
+
+    def update(self, value, scale=1):
+        for f in self.filters:
+            value = f.update(value, scale)
+        return value
+
+    def get_json(self):
+        """return data as list for json"""
+        return [f.get_json() for f in self.filters]
@@ -3,6 +3,9 @@ import vendors
 from thermal_zone import ThermalZone
 from cooling_device import CoolingDevice
 
+# directory of the hwmon class, a simulated tree (see simulator) replaces it
+HWMON_BASE = "/sys/class/hwmon"
+
 
 def find_files(root, file_querys, max_depth=3, exclude=[]):
     rval = dict.fromkeys(file_querys, [])
@@ -92,10 +95,10 @@ class HwMon:
             self.cooling_devices.append(cooling_device)
 
 
-def get_all_hwmons(control):
+def get_all_hwmons(control, base=None):
     """find all thermal zones"""
 
-    base = "/sys/class/hwmon"  # base directory for hwmons
+    base = base if base is not None else HWMON_BASE  # base directory for hwmons
     hwmons = os.listdir(base)  # list all hwmons in hwmons
     result = []
     for hwmon_path in hwmons:
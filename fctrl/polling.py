@@ -0,0 +1,104 @@
+# coding=utf-8
+"""adaptive control interval driven by the thermal dynamics"""
+from collections import deque
+
+MAX_RESOLUTION = 1
+
+
+class AdaptiveInterval:
+    """engine listener choosing the control interval from zone scores and temperature slopes
+
+    while every zone is under idle (score < 1) and flat (|slope| < flat-slope °C/s) the interval grows by growth
+    per tick up to idle-interval. once any zone reaches burst-score or changes faster than burst-slope the
+    interval snaps to fast-interval and stays there for burst-hold seconds after the last trigger, otherwise it
+    returns to interval. the effective interval is exported as interval and as the period of the engines control
+    task. slopes are least squares fits over the last slope-window seconds, so a whole degree sensor flipping
+    between two readings is flat, and a drift over the window no bigger than the resolution of the zone (its
+    smallest change seen, at most 1 °C) counts as none. the control law is tuned per interval, shorter and
+    longer ticks scale its steps (Sampler.get_time_scale)."""
+
+    def __init__(self, data=None):
+        self.load_json(data)
+        self.interval = self.base_interval
+        self.mode = "base"
+        self.ticks = {"idle": 0, "base": 0, "burst": 0}
+        self.__temps = {}
+        self.__resolutions = {}
+        self.__burst_until = None
+
+    def load_json(self, data):
+        """sets the limits, may be called on a running instance"""
+        data = data if data is not None else {}
+        self.adaptive = data.get("adaptive", True)
+        self.base_interval = data.get("interval", 1)
+        self.fast_interval = data.get("fast-interval", 0.25)
+        self.idle_interval = data.get("idle-interval", 5)
+        self.growth = data.get("growth", 1.5)
+        self.flat_slope = data.get("flat-slope", 0.05)
+        self.burst_slope = data.get("burst-slope", 0.5)
+        self.burst_score = data.get("burst-score", 2)
+        self.burst_hold = data.get("burst-hold", 5)
+        self.slope_window = data.get("slope-window", 10)
+
+    def get_json(self):
+        """return data as dict for json"""
+        return {"adaptive": self.adaptive, "interval": self.base_interval, "fast-interval": self.fast_interval,
+                "idle-interval": self.idle_interval, "growth": self.growth, "flat-slope": self.flat_slope,
+                "burst-slope": self.burst_slope, "burst-score": self.burst_score, "burst-hold": self.burst_hold,
+                "slope-window": self.slope_window}
+
+    def get_slope(self, zone, temp, now):
+        """returns rate of change of zone in °C/s over the slope window, 0 for the first call or a drift within the
+        resolution of the zone"""
+        samples = self.__temps.setdefault(zone, deque())
+        if temp is None:
+            return 0
+        if samples and now <= samples[-1][0]:
+            samples.pop()
+        if samples and temp != samples[-1][1]:
+            # hwmon sensors resolve at least whole degrees, a first large step is no resolution
+            change = min(abs(temp - samples[-1][1]), MAX_RESOLUTION)
+            self.__resolutions[zone] = min(self.__resolutions.get(zone, change), change)
+        samples.append((now, temp))
+        while now - samples[0][0] > self.slope_window:
+            samples.popleft()
+        if len(samples) < 2:
+            return 0
+
+        count = len(samples)
+        mean_t = sum(t for t, _ in samples) / count
+        mean_v = sum(v for _, v in samples) / count
+        slope = (sum((t - mean_t) * (v - mean_v) for t, v in samples) /
+                 sum((t - mean_t) ** 2 for t, _ in samples))
+        if abs(slope) * (now - samples[0][0]) <= self.__resolutions.get(zone, 0):
+            return 0
+        return slope
+
+    def update(self, zones, now):
+        """returns the interval for the next tick given the zones at time now"""
+        idle = True
+        for zone in zones:
+            score = zone.score
+            slope = abs(self.get_slope(zone, zone.temp, now))
+            if score >= self.burst_score or slope >= self.burst_slope:
+                self.__burst_until = now + self.burst_hold
+            if score >= 1 or slope >= self.flat_slope:
+                idle = False
+        burst = self.__burst_until is not None and now < self.__burst_until
+
+        if not self.adaptive:
+            self.mode, self.interval = "base", self.base_interval
+        elif burst:
+            self.mode, self.interval = "burst", self.fast_interval
+        elif idle:
+            self.mode = "idle"
+            self.interval = min(max(self.interval, self.base_interval) * self.growth, self.idle_interval)
+        else:
+            self.mode, self.interval = "base", self.base_interval
+        self.ticks[self.mode] += 1
+        return self.interval
+
+    def __call__(self, engine, snapshot):
+        interval = self.update(engine.control.thermal_manager.thermal_zones, snapshot.time)
+        if interval != engine.interval:
+            engine.interval = interval
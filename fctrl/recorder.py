@@ -0,0 +1,173 @@
+# coding=utf-8
+"""memory mapped ring file recording every tick of the control loop
+
+file layout (all little endian):
+    header   magic "FCTRLREC", u32 version, u32 header size, u32 record size, u32 capacity, u64 records written,
+             followed by the channel names as json list, zero padded to header size
+    records  capacity fixed width records at header size + (n % capacity) * record size:
+             f64 time (monotonic), u32 tick, f32 per channel (nan if unavailable)
+
+the record being written may be torn, readers should skip the slot at records written % capacity."""
+import json
+import mmap
+import os
+import struct
+from math import nan
+
+MAGIC = b"FCTRLREC"
+VERSION = 1
+HEADER = struct.Struct("<8sIIIIQ")
+COUNT = struct.Struct("<Q")
+COUNT_OFFSET = HEADER.size - COUNT.size
+ALIGNMENT = 64
+
+
+def get_unique_names(names):
+    """returns names with repeated ones numbered in order of appearance, e.g. sensors without a label:
+    acpitz/unnamed, acpitz/unnamed#2"""
+    seen = {}
+    result = []
+    for name in names:
+        seen[name] = seen.get(name, 0) + 1
+        result.append(name if seen[name] == 1 else name + "#" + str(seen[name]))
+    return result
+
+
+def get_channels(zones, devices):
+    """returns channel names recorded for zones and devices, named by their unique full names (see
+    get_unique_names)"""
+    channels = []
+    for name in get_unique_names([zone.full_name for zone in zones]):
+        channels += [name + ":temp", name + ":score"]
+    for name in get_unique_names([device.full_name for device in devices]):
+        channels += [name + ":duty", name + ":pwm", name + ":rpm", name + ":build-up"]
+    return channels
+
+
+def read_header(buffer):
+    """returns header of a recording as dict"""
+    magic, version, header_size, record_size, capacity, count = HEADER.unpack_from(buffer, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a fctrl recording")
+    channels = json.loads(bytes(buffer[HEADER.size:header_size]).rstrip(b"\0").decode())
+    return {"header-size": header_size, "record-size": record_size, "capacity": capacity, "count": count,
+            "channels": channels}
+
+
+def get_dtype(channels):
+    """returns numpy dtype description of a record"""
+    return [("time", "<f8"), ("tick", "<u4")] + [(channel, "<f4") for channel in channels]
+
+
+def open_recording(path):
+    """returns header and zero copy numpy.memmap of all records (requires numpy), records in slot order"""
+    import numpy as np
+    with open(path, "rb") as file:
+        header = read_header(file.read(os.path.getsize(path)))
+    records = np.memmap(path, dtype=np.dtype(get_dtype(header["channels"])), mode="r",
+                        offset=header["header-size"], shape=(header["capacity"],))
+    return header, records
+
+
+def iter_records(path):
+    """yields complete records oldest first as (time, tick, values) without numpy"""
+    with open(path, "rb") as file:
+        buffer = file.read()
+    header = read_header(buffer)
+    record = struct.Struct("<dI" + "f" * len(header["channels"]))
+    count, capacity = header["count"], header["capacity"]
+    # the slot of the oldest record is the one overwritten next, it may be torn
+    for n in range(max(count - capacity + 1, 0), count):
+        values = record.unpack_from(buffer, header["header-size"] + (n % capacity) * header["record-size"])
+        yield values[0], values[1], values[2:]
+
+
+class FlightRecorder:
+    """engine listener appending one record per tick to a fixed size ring file (capacity records)
+
+    an existing file with the same channels and capacity is continued (e.g. after a daemon restart). when the
+    channels change (zones or devices added, removed or renamed) the old file is rotated to path.1 and a new
+    one is started, so the history is never truncated."""
+
+    def __init__(self, path, capacity=86400):
+        self.path = path
+        self.capacity = capacity
+        self.channels = []
+        self.count = 0
+        self.__mmap = None
+        self.__record = None
+        self.__header_size = 0
+        self.__zones = None
+        self.__devices = None
+
+    def open(self, zones, devices):
+        """opens the ring file for zones and devices, continues a matching existing file"""
+        self.close()
+        self.__zones, self.__devices = zones, devices
+        self.channels = get_channels(zones, devices)
+        self.__record = struct.Struct("<dI" + "f" * len(self.channels))
+        names = json.dumps(self.channels).encode()
+        self.__header_size = -(-(HEADER.size + len(names) + 1) // ALIGNMENT) * ALIGNMENT
+        self.count = 0
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path):
+            if self.__reopen():
+                return
+            os.replace(self.path, self.path + ".1")
+
+        with open(self.path, "w+b") as file:
+            file.truncate(self.__header_size + self.capacity * self.__record.size)
+            self.__mmap = mmap.mmap(file.fileno(), 0)
+        HEADER.pack_into(self.__mmap, 0, MAGIC, VERSION, self.__header_size, self.__record.size, self.capacity, 0)
+        self.__mmap[HEADER.size:HEADER.size + len(names)] = names
+
+    def __reopen(self):
+        """maps the existing file if it was written with the current channels and capacity, returns success"""
+        try:
+            with open(self.path, "r+b") as file:
+                header = read_header(file.read(os.path.getsize(self.path)))
+                expected = (self.__header_size, self.__record.size, self.capacity, self.channels)
+                if (header["header-size"], header["record-size"], header["capacity"], header["channels"]) != expected \
+                        or os.path.getsize(self.path) != self.__header_size + self.capacity * self.__record.size:
+                    return False
+                self.__mmap = mmap.mmap(file.fileno(), 0)
+        except (OSError, ValueError, struct.error):
+            return False
+        self.count = header["count"]
+        return True
+
+    def close(self):
+        if self.__mmap is not None:
+            self.__mmap.close()
+            self.__mmap = None
+
+    def record(self, control, snapshot):
+        """appends the state of control at snapshot"""
+        zones, devices = control.thermal_manager.thermal_zones, control.cooling_manager.cooling_devices
+        if zones is not self.__zones or devices is not self.__devices:
+            # a config reload replaces the lists, only changed channels start a new file
+            if get_channels(zones, devices) == self.channels and self.__mmap is not None:
+                self.__zones, self.__devices = zones, devices
+            else:
+                self.open(zones, devices)
+
+        values = []
+        for zone in zones:
+            values.append(zone.temp)
+            values.append(zone.score)
+        for device in devices:
+            values.append(device.buffer_speed)
+            values.append(device.speed)
+            values.append(device.rpm)
+            values.append(device.build_up)
+        if None in values:
+            values = [nan if value is None else value for value in values]
+
+        self.__record.pack_into(self.__mmap, self.__header_size + (self.count % self.capacity) * self.__record.size,
+                                snapshot.time, snapshot.tick, *values)
+        self.count += 1
+        COUNT.pack_into(self.__mmap, COUNT_OFFSET, self.count)
+
+    def __call__(self, engine, snapshot):
+        self.record(engine.control, snapshot)
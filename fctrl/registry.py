@@ -0,0 +1,45 @@
+# coding=utf-8
+"""indexed lookups over the lists of thermal zones and cooling devices"""
+
+
+class Registry:
+    """dict index over a list of objects (e.g. thermal zones by full name) for O(1) lookups
+
+    the list stays the single source of truth: the index is rebuilt when the list was replaced or resized or when
+    the key of the found object changed (e.g. a renamed device). keys that are not found are remembered until the
+    next rebuild, callers probing several keys (name, then full name) stay O(1). for duplicate keys the first
+    object wins, like a linear scan."""
+
+    def __init__(self, get_items, key):
+        self.get_items = get_items
+        self.key = key
+        self.rebuilds = 0
+        self.__items = None
+        self.__size = 0
+        self.__index = {}
+        self.__missing = set()
+
+    def rebuild(self):
+        items = self.get_items()
+        self.__items = items
+        self.__size = len(items)
+        self.__index = {}
+        self.__missing = set()
+        for item in items:
+            self.__index.setdefault(self.key(item), item)
+        self.rebuilds += 1
+
+    def get(self, key):
+        """returns object with key, None if unavailable"""
+        items = self.get_items()
+        if items is not self.__items or len(items) != self.__size:
+            self.rebuild()
+        elif key in self.__missing:
+            return None
+        item = self.__index.get(key)
+        if item is not None and self.key(item) != key:
+            self.rebuild()
+            item = self.__index.get(key)
+        if item is None:
+            self.__missing.add(key)
+        return item
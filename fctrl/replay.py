@@ -0,0 +1,253 @@
+# coding=utf-8
+"""faster than real time replay of temperature traces through the control loop
+
+a trace is a list of (time in s, {zone full name: °C}) samples, the key "*" applies to every zone without an own
+value. zones sharing a full name are numbered like the recorder channels (see recorder.get_unique_names).
+traces are loaded from the legacy format (°C separated by ";", one sample per interval, e.g. cpu_2) or from
+flight recorder files (the ":temp" channels). the replay runs the unmodified ThermalManager and
+CoolingManager of a FanControl built from a config on a virtual clock: every tick commits the trace
+temperatures, the commanded pwm and the rpm the fan model expects for it as the snapshot, so nothing is read
+from or written to the hardware. ticks follow the polling intervals of the config (AdaptiveInterval), the trace
+is linearly interpolated between its samples."""
+import csv
+from bisect import bisect_right
+import math
+import os
+import tempfile
+from time import perf_counter
+
+from fctrl import FanControl
+from recorder import get_unique_names, iter_records, read_header
+from telemetry import telemetry
+
+MIN_INTERVAL = 0.01
+
+
+def read_legacy_trace(path):
+    """returns temperatures in °C of a legacy trace file"""
+    with open(path) as file:
+        return [float(value) for value in file.read().replace("\n", ";").split(";") if value.strip()]
+
+
+def load_legacy_trace(path, interval=1, zones=None):
+    """returns trace of a legacy file sampled every interval seconds, applied to zones (full names, all if None)"""
+    keys = zones or ["*"]
+    return [(i * interval, dict.fromkeys(keys, temp)) for i, temp in enumerate(read_legacy_trace(path))]
+
+
+def load_recorded_trace(path, zones=None):
+    """returns trace of the zone temperatures in a flight recorder file, restricted to zones if given"""
+    with open(path, "rb") as file:
+        names = read_header(file.read())["channels"]
+    channels = [(i, name[:-len(":temp")]) for i, name in enumerate(names) if name.endswith(":temp")]
+    if zones:
+        channels = [(i, name) for i, name in channels if name in zones]
+
+    trace = []
+    start = None
+    for time, _, values in iter_records(path):
+        if start is None:
+            start = time
+        temps = {name: values[i] for i, name in channels if not math.isnan(values[i])}
+        trace.append((time - start, temps))
+    return trace
+
+
+def load_trace(path, interval=1, zones=None):
+    """returns trace of a flight recorder or legacy file"""
+    with open(path, "rb") as file:
+        magic = file.read(8)
+    if magic == b"FCTRLREC":
+        return load_recorded_trace(path, zones)
+    return load_legacy_trace(path, interval, zones)
+
+
+def get_series(trace):
+    """returns {key: (times, temps, resolution)} of the samples of every zone name (and "*") in trace
+
+    resolution is the smallest change between two samples (at most 1 °C), 0 if the temperature never changes."""
+    series = {}
+    for time, sample in trace:
+        for key, temp in sample.items():
+            times, temps = series.setdefault(key, ([], []))
+            times.append(time)
+            temps.append(temp)
+    for key, (times, temps) in series.items():
+        steps = [abs(b - a) for a, b in zip(temps, temps[1:]) if b != a]
+        series[key] = (times, temps, min(steps + [1]) if steps else 0)
+    return series
+
+
+def interpolate(times, temps, time, resolution=0):
+    """returns temperature at time linearly interpolated between the samples, the last one after the last
+    sample, None before the first
+
+    the interpolated change is rounded to resolution, a trace of whole degrees stays whole degrees like the sensor it
+    was read from (fractions would look like slow drifts to the adaptive polling)."""
+    i = bisect_right(times, time)
+    if i == 0:
+        return None
+    if i == len(times) or times[i] == times[i - 1]:
+        return temps[i - 1]
+    change = (temps[i] - temps[i - 1]) * (time - times[i - 1]) / (times[i] - times[i - 1])
+    return temps[i - 1] + (round(change / resolution) * resolution if resolution else change)
+
+
+def sandbox_config(data, directory):
+    """returns copy of config data with all pwm paths moved below directory, creating the pwm, enable and fan
+    files there, so stray writes (e.g. the critical response) never reach the hardware"""
+    cooling = dict(data["cooling"])
+    cooling["devices"] = []
+    for device in data["cooling"]["devices"]:
+        device = dict(device)
+        base_path = os.path.join(directory, device["base-path"].lstrip("/"))
+        os.makedirs(os.path.dirname(base_path), exist_ok=True)
+        fan_path = os.path.join(os.path.dirname(base_path), "fan" + str(device["index"]) + "_input")
+        for path, content in ((base_path, "0"), (base_path + "_enable", "1"), (fan_path, "0")):
+            with open(path, "w") as file:
+                file.write(content)
+        device["base-path"] = base_path
+        cooling["devices"].append(device)
+    result = dict(data)
+    result["cooling"] = cooling
+    return result
+
+
+class ReplayResult:
+    """duty timeline of a replay with zone temperatures and summary metrics"""
+
+    def __init__(self, times, zones, thresholds, temps, devices, duties, wall_time, pwm_writes, polling=None):
+        self.times = times
+        self.zones = zones
+        self.thresholds = thresholds
+        self.temps = temps
+        self.devices = devices
+        self.duties = duties
+        self.wall_time = wall_time
+        self.pwm_writes = pwm_writes
+        self.polling = polling or {}
+
+    def get_durations(self):
+        """returns seconds each sample was in effect"""
+        if len(self.times) < 2:
+            return [1] * len(self.times)
+        durations = [b - a for a, b in zip(self.times, self.times[1:])]
+        return durations + durations[-1:]
+
+    def summary(self):
+        """returns metrics of devices and zones as dict
+
+        polling: ticks per polling mode. devices: mean and max duty in %, starts (stopped -> running), changes,
+        travel (sum of duty changes in %) and stopped (fraction of time at 0%). zones: max and mean °C and seconds
+        above desired and critical."""
+        durations = self.get_durations()
+        duration = sum(durations)
+        result = {"ticks": len(self.times), "duration": duration, "wall-time": self.wall_time,
+                  "speedup": duration / self.wall_time if self.wall_time else None, "pwm-writes": self.pwm_writes,
+                  "polling": dict(self.polling), "devices": {}, "zones": {}}
+
+        for i, name in enumerate(self.devices):
+            duties = [row[i] for row in self.duties]
+            changes = [abs(b - a) for a, b in zip(duties, duties[1:]) if b != a]
+            result["devices"][name] = {
+                "mean": sum(d * t for d, t in zip(duties, durations)) / duration if duration else 0,
+                "max": max(duties, default=0),
+                "starts": sum(1 for a, b in zip(duties, duties[1:]) if a == 0 and b > 0),
+                "changes": len(changes), "travel": sum(changes),
+                "stopped": sum(t for d, t in zip(duties, durations) if d == 0) / duration if duration else 0}
+
+        for i, (name, (desired, critical)) in enumerate(zip(self.zones, self.thresholds)):
+            temps = [row[i] for row in self.temps]
+            result["zones"][name] = {
+                "max": max(temps, default=None),
+                "mean": sum(temp * t for temp, t in zip(temps, durations)) / duration if duration else None,
+                "above-desired": sum(t for temp, t in zip(temps, durations) if temp > desired),
+                "above-critical": sum(t for temp, t in zip(temps, durations) if temp > critical)}
+        return result
+
+    def write_csv(self, file):
+        """writes the timeline (time, zone temperatures in °C, device duties in %) as csv to file"""
+        writer = csv.writer(file)
+        writer.writerow(["time"] + [name + ":temp" for name in self.zones] + [name + ":duty" for name in self.devices])
+        for time, temps, duties in zip(self.times, self.temps, self.duties):
+            writer.writerow([round(time, 3)] + temps + [round(duty, 2) for duty in duties])
+
+
+class Replay:
+    """replays traces through the control loop configured by data (see FanControl.save)
+
+    the config is copied with its pwm files moved to a temporary directory (workdir if given)."""
+
+    def __init__(self, data, workdir=None):
+        self.data = data
+        self.workdir = workdir
+
+    def run(self, trace):
+        """replays trace ticking at the polling intervals of the config, returns ReplayResult"""
+        with tempfile.TemporaryDirectory(prefix="fctrl-replay-", dir=self.workdir) as directory:
+            # the replay reports through its result, thousands of speed peaks per second would flood the log
+            previous = telemetry.get_json()
+            control = FanControl(sandbox_config(self.data, directory))
+            telemetry.configure(dict(previous, level="error"))
+            try:
+                return self.__run(control, trace)
+            finally:
+                telemetry.configure(previous)
+
+    def __run(self, control, trace):
+        zones = control.thermal_manager.thermal_zones
+        devices = control.cooling_manager.cooling_devices
+        sampler, cooling_manager = control.sampler, control.cooling_manager
+        names = get_unique_names([zone.full_name for zone in zones])
+        device_names = get_unique_names([device.full_name for device in devices])
+        zone_inputs = [(name, zone.input_paths) for name, zone in zip(names, zones)]
+        # zones not covered by the trace read their idle temperature, they never drive a fan. zones share sensors
+        # (e.g. CPU and its cores), the traced temperature wins
+        current = {name: zone.idle for name, zone in zip(names, zones)}
+        covered = set()
+        device_paths = [(device, device.base_path, device.get_path(fan=True) + "_input") for device in devices]
+        series = get_series(trace)
+        zone_series = [(name, series.get(name), series.get("*")) for name in current]
+        polling = control.polling
+        end = trace[-1][0] if trace else 0
+
+        times, temps, duties = [], [], []
+        started = perf_counter()
+        time = trace[0][0] if trace else 1
+        while time <= end:
+            for name, own, default in zone_series:
+                temp = None
+                for samples in (own, default):
+                    if temp is None and samples is not None:
+                        temp = interpolate(*samples, time)
+                if temp is not None:
+                    current[name] = temp
+                    covered.add(name)
+
+            values = {}
+            for traced in (False, True):
+                for name, paths in zone_inputs:
+                    if (name in covered) == traced:
+                        milli = int(current[name] * 1000)
+                        for path in paths:
+                            values[path] = milli
+            for device, pwm_path, fan_path in device_paths:
+                speed = device.buffer_speed
+                rpm = device.fan_model.rpm(speed)
+                values[pwm_path] = int(round(max(min(speed / 100 * 255, 255), 0)))
+                values[fan_path] = None if rpm is None else int(rpm)
+            sampler.commit(values, time)
+
+            for device, speed in cooling_manager.compute_speeds():
+                device.set_speed(speed)
+            times.append(time)
+            temps.append([zone.temp for zone in zones])
+            # the curve may ask for more than 100% (e.g. above critical), the pwm saturates
+            duties.append([min(max(device.buffer_speed, 0), 100) for device in devices])
+            # the next tick as the engine schedules it, a zero interval must not stall the replay
+            time += max(polling.update(zones, time), MIN_INTERVAL)
+        wall_time = perf_counter() - started
+
+        return ReplayResult(times, [name for name, _ in zone_inputs], [(zone.desired, zone.critical) for zone in zones],
+                            temps, device_names, duties, wall_time,
+                            cooling_manager.get_write_stats()["written"], polling.ticks)
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""closed loop rpm control of a fan"""
+
+
+def clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+class RpmController:
+    """PI controller driving the speed in % of a fan to a target rpm
+
+    the PI terms produce an rpm correction that is fed through the inverse fan model (feedforward), so the
+    controller only has to learn the model error (e.g. a fan spinning 15% faster than the detected curve) and
+    settles within one to two ticks. the measured rpm is compared against the target of the previous tick,
+    since that is the command the fan responded to. kp and ki are unitless (rpm per rpm of error), ki integrates
+    per base interval. the fan counts as responsive while it runs within tolerance (fraction of its max rpm) of
+    the target it can reach."""
+
+    def __init__(self, fan_model, data=None):
+        data = data if data is not None else {}
+        self.data = dict(data)
+        self.fan_model = fan_model
+        self.kp = data.get("kp", 0.2)
+        self.ki = data.get("ki", 0.8)
+        self.max_rpm = data.get("max-rpm")
+        self.tolerance = data.get("tolerance", 0.1)
+        self.integral = 0
+        self.target_rpm = None
+
+    def get_json(self):
+        """return data as dict for json"""
+        return self.data
+
+    @property
+    def has_model(self):
+        """returns whether the fan model maps rpm to speed, an empty or never spinning model does not"""
+        return self.fan_model.max_rpm > 0
+
+    def reset(self):
+        self.integral = 0
+        self.target_rpm = None
+
+    def get_target_rpm(self, speed):
+        """returns target rpm for curve speed in %, relative to max-rpm (shared by fans on one curve)
+        or the fans own max rpm"""
+        max_rpm = self.max_rpm if self.max_rpm is not None else self.fan_model.max_rpm
+        return speed / 100 * max_rpm
+
+    def feedforward(self, target_rpm):
+        """returns speed in % the fan model expects for target_rpm"""
+        if not self.has_model:
+            raise ValueError("rpm control needs a fan model with a max rpm above 0")
+        if target_rpm >= self.fan_model.max_rpm:
+            return 100
+        speed_range = self.fan_model.speed(target_rpm)
+        if speed_range is None:
+            return 0
+        return (speed_range[0] + speed_range[1]) / 2
+
+    def update(self, target_rpm, rpm, min_speed=0, scale=1):
+        """returns new speed in % for target_rpm given the measured rpm (None without tachometer), scale is the
+        length of the tick in base intervals"""
+        proportional = 0
+        if self.target_rpm is not None and rpm is not None:
+            error = self.target_rpm - rpm
+            proportional = self.kp * error
+            saturated = self.feedforward(self.target_rpm + self.integral) >= 100
+            # anti windup: stop integrating while the fan is at full speed and still too slow
+            if not (saturated and error > 0):
+                limit = self.fan_model.max_rpm / 2
+                self.integral = clamp(self.integral + self.ki * error * scale, -limit, limit)
+        self.target_rpm = target_rpm
+
+        return clamp(self.feedforward(target_rpm + self.integral + proportional), min_speed, 100)
+
+    def is_responsive(self, rpm):
+        """returns whether the measured rpm (None without tachometer) follows the target of the last update"""
+        if self.target_rpm is None:
+            return True
+        if rpm is None:
+            return False
+        max_rpm = self.fan_model.max_rpm
+        return abs(rpm - min(self.target_rpm, max_rpm)) <= self.tolerance * max_rpm
@@ -0,0 +1,86 @@
+# coding=utf-8
+"""tick scoped sensor snapshots"""
+from time import monotonic
+from types import MappingProxyType
+
+# longest tick the control law catches up on at once (e.g. after a suspend), in base intervals
+MAX_TIME_SCALE = 10
+
+
+class Snapshot:
+    """immutable readings of every sampled attribute at one tick, keyed by path"""
+
+    __slots__ = ("tick", "time", "elapsed", "values")
+
+    def __init__(self, tick, time, values, elapsed=None):
+        self.tick = tick
+        self.time = time
+        self.elapsed = elapsed
+        self.values = MappingProxyType(values)
+
+    def __contains__(self, path):
+        return path in self.values
+
+    def get(self, path, default=None):
+        """returns reading of attribute path"""
+        return self.values.get(path, default)
+
+
+class Sampler:
+    """reads the de-duplicated set of known attributes exactly once per tick
+
+    attributes are learned on first access through read_int, so ThermalZones and CoolingDevices
+    sharing a file (e.g. ThermalCpu and the single core zones) cost one read per tick.
+
+    the control law (build up, smoothing, filters) is tuned for ticks of base_interval seconds, ticks of other
+    lengths (adaptive interval, wakeups) scale their steps by get_time_scale."""
+
+    def __init__(self):
+        self.__attributes = {}
+        self.tick = 0
+        self.snapshot = None
+        self.base_interval = 1
+
+    @property
+    def attributes(self):
+        """returns all sampled attributes"""
+        return list(self.__attributes.values())
+
+    def register(self, attribute):
+        """adds attribute to the set read on every tick"""
+        self.__attributes[attribute.path] = attribute
+
+    def reset(self):
+        """forgets all attributes and the current snapshot"""
+        self.__attributes = {}
+        self.snapshot = None
+
+    def sample(self):
+        """reads every registered attribute once, returns the new Snapshot"""
+        return self.commit({path: attribute.read_int() for path, attribute in self.__attributes.items()})
+
+    def commit(self, values, time=None):
+        """installs values (path -> reading) as the snapshot of a new tick at time (now if None), returns the new
+        Snapshot"""
+        self.tick += 1
+        time = monotonic() if time is None else time
+        elapsed = time - self.snapshot.time if self.snapshot is not None else None
+        self.snapshot = Snapshot(self.tick, time, values, elapsed)
+        return self.snapshot
+
+    def get_time_scale(self):
+        """returns length of the current tick in base intervals (1 without a previous tick)"""
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.elapsed is None:
+            return 1
+        return min(max(snapshot.elapsed, 0) / self.base_interval, MAX_TIME_SCALE)
+
+    def read_int(self, attribute):
+        """returns value of attribute in the current snapshot, reads it live if not sampled yet"""
+        snapshot = self.snapshot
+        if snapshot is not None and attribute.path in snapshot.values:
+            return snapshot.values[attribute.path]
+
+        if attribute.path not in self.__attributes:
+            self.register(attribute)
+        return attribute.read_int()
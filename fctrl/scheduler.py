@@ -0,0 +1,138 @@
+# coding=utf-8
+"""drift free scheduling of periodic tasks on monotonic deadlines"""
+from collections import deque
+from time import monotonic
+
+
+class PeriodicTask:
+    """func called every period seconds, phase seconds after the scheduler started
+
+    deadlines are computed as anchor + n * period instead of being summed up, so they do not drift."""
+
+    def __init__(self, name, func, period, phase=0):
+        self.name = name
+        self.func = func
+        self.period = period
+        self.phase = phase
+        self.runs = 0
+        self.missed = 0
+        self.errors = 0
+        self.triggered = False
+        self.triggered_runs = 0
+        self.last_lateness = 0
+        self.max_lateness = 0
+        self.__anchor = 0
+        self.__count = 0
+
+    @property
+    def deadline(self):
+        """returns next deadline in seconds of the scheduler clock"""
+        return self.__anchor + self.__count * self.period
+
+    def start(self, now):
+        self.__anchor = now + self.phase
+        self.__count = 0
+
+    def set_period(self, period):
+        """changes the period, the pending deadline (the current one while running) is kept, the following
+        ones are period seconds apart"""
+        self.__anchor = self.deadline
+        self.__count = 0
+        self.period = period
+
+    def trigger(self):
+        """makes the task due immediately, without moving its deadlines"""
+        self.triggered = True
+
+    def advance(self, now):
+        """moves to the next deadline after a run finished at now, returns number of skipped deadlines"""
+        self.runs += 1
+        self.__count += 1
+        if now < self.deadline:
+            return 0
+        # overran at least one period, keep cadence instead of stretching the loop
+        skipped = int((now - self.deadline) // self.period) + 1
+        self.__count += skipped
+        self.missed += skipped
+        return skipped
+
+
+class Scheduler:
+    """keeps a set of PeriodicTasks with their own periods and phases on one monotonic clock
+
+    the caller runs the tasks returned by get_due and reports them with done. overruns are recorded as missed
+    deadlines (see misses) instead of delaying the following deadlines. speed is the rate of clock relative to
+    wall time (above 1 for a simulated clock), waits on the wall clock are divided by it."""
+
+    def __init__(self, clock=monotonic, max_misses=100, speed=1):
+        self.clock = clock
+        self.speed = speed
+        self.tasks = []
+        self.misses = deque(maxlen=max_misses)
+        self.__started = None
+
+    def add(self, name, func, period, phase=0):
+        """registers func(), returns the PeriodicTask"""
+        task = PeriodicTask(name, func, period, phase)
+        if self.__started is not None:
+            task.start(self.clock())
+        self.tasks.append(task)
+        return task
+
+    def remove(self, name):
+        self.tasks = [task for task in self.tasks if task.name != name]
+
+    def get_task(self, name):
+        """returns task with name, None if unavailable"""
+        for task in self.tasks:
+            if task.name == name:
+                return task
+        return None
+
+    def start(self, now=None):
+        """anchors all deadlines at now"""
+        self.__started = self.clock() if now is None else now
+        for task in self.tasks:
+            task.start(self.__started)
+
+    def next_deadline(self):
+        """returns earliest deadline of all tasks, None without tasks"""
+        return min((task.deadline for task in self.tasks), default=None)
+
+    def get_due(self, now=None):
+        """returns tasks with a deadline at or before now, earliest first"""
+        now = self.clock() if now is None else now
+        return sorted((task for task in self.tasks if task.deadline <= now or task.triggered),
+                      key=lambda task: task.deadline)
+
+    def trigger(self, name):
+        """makes task with name due immediately (e.g. on a hardware alarm), returns the task"""
+        task = self.get_task(name)
+        if task is not None:
+            task.trigger()
+        return task
+
+    def done(self, task, started, now=None):
+        """records a run of task that started at started and finished at now"""
+        now = self.clock() if now is None else now
+        if task.triggered and started < task.deadline:
+            # extra run before the deadline, the cadence is kept
+            task.triggered = False
+            task.runs += 1
+            task.triggered_runs += 1
+            return
+        task.triggered = False
+        task.last_lateness = max(started - task.deadline, 0)
+        task.max_lateness = max(task.max_lateness, task.last_lateness)
+        deadline = task.deadline
+        skipped = task.advance(now)
+        if skipped:
+            self.misses.append({"task": task.name, "deadline": deadline, "missed": skipped,
+                                "overrun": now - deadline - task.period})
+
+    def get_stats(self):
+        """returns runs, missed deadlines and lateness in seconds of all tasks"""
+        return {task.name: {"period": task.period, "runs": task.runs, "missed": task.missed, "errors": task.errors,
+                            "triggered": task.triggered_runs,
+                            "last_lateness": task.last_lateness, "max_lateness": task.max_lateness}
+                for task in self.tasks}
@@ -0,0 +1,125 @@
+# coding=utf-8
+"""steady state detection of fan readings, replaces fixed sleeps during detection"""
+from time import monotonic, sleep
+
+
+def now():
+    """returns monotonic time, looked up on every call so a simulated clock (see simulator) applies"""
+    return monotonic()
+
+
+def wait(seconds):
+    """sleeps seconds, looked up on every call like now"""
+    sleep(seconds)
+
+
+def fit(samples):
+    """returns least squares line of (time, value) samples as (mean time, mean value, slope, residual standard
+    deviation)"""
+    count = len(samples)
+    mean_t = sum(t for t, _ in samples) / count
+    mean_v = sum(v for _, v in samples) / count
+    var_t = sum((t - mean_t) ** 2 for t, _ in samples)
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in samples) / var_t if var_t else 0
+    residuals = sum((v - mean_v - slope * (t - mean_t)) ** 2 for t, v in samples)
+    return mean_t, mean_v, slope, (residuals / count) ** 0.5
+
+
+def get_drift(samples, noise):
+    """returns drift of samples over their window (least squares slope * duration) and the limit it has to stay
+    within to count as steady: the tach noise (the residual deviation around the fit, at least noise)"""
+    _, _, slope, deviation = fit(samples)
+    return abs(slope) * (samples[-1][0] - samples[0][0]), max(deviation, noise)
+
+
+def is_steady(samples, tolerance, min_tolerance):
+    """returns whether (time, value) samples are flat: the drift over the window is within the tach noise (see
+    get_drift, at least min_tolerance) and the noise itself is within tolerance * mean"""
+    _, mean_v, _, deviation = fit(samples)
+    drift, limit = get_drift(samples, min_tolerance)
+    return deviation <= max(tolerance * abs(mean_v), min_tolerance) and drift <= limit
+
+
+class SettleDetector:
+    """samples a reading (e.g. fan rpm) at a high rate until it is in steady state or a timeout is hit
+
+    chips refresh their tach registers only every update_interval seconds (about 1s on nct6775), so a window
+    of repeated readings may still show the value from before a speed change. the window spans at least three
+    register updates and a reading counts as steady once its drift over the window is within the tach noise (see
+    is_steady), a fan still speeding up or slowing down drifts by more than its noise.
+
+    every wait may be given the fixed sleep it replaces as budget, the difference is summed up in saved. saved
+    is negative when the waits took longer than the sleeps they replace."""
+
+    def __init__(self, read, interval=0.2, window=3, tolerance=0.03, min_tolerance=10, timeout=15,
+                 clock=now, sleep=wait, update_interval=1):
+        self.read = read
+        self.interval = interval
+        self.window = window
+        self.update_interval = update_interval
+        self.tolerance = tolerance
+        self.min_tolerance = min_tolerance
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+        self.saved = 0
+        self.spent = 0
+        self.value = None
+        self.confidence = 0
+
+    def __set_result(self, samples, settled):
+        """stores the end of the least squares line through the last window as value, a fan still moving is
+        ahead of the mean of the window. confidence is 1 for a reading without drift, 0.5
+        at the steady state limit and falls towards 0 above it, halved if the reading did not settle"""
+        if not samples:
+            self.value = self.read()
+            self.confidence = 0
+            return
+
+        mean_t, mean_v, slope, _ = fit(samples)
+        self.value = mean_v + slope * (samples[-1][0] - mean_t)
+        drift, limit = get_drift(samples, self.min_tolerance)
+        self.confidence = limit / (limit + drift) * (1 if settled else 0.5)
+
+    def wait(self, condition=None, timeout=None, window=None, budget=None, p=False, out=None):
+        """waits until condition(value) holds and the reading stayed steady for window seconds,
+        returns False on timeout. prints a # per second to out (stdout if None) if p is set"""
+        timeout = self.timeout if timeout is None else timeout
+        window = max(self.window if window is None else window, 3 * self.update_interval)
+        start = self.clock()
+        next_print = start + 1
+        samples = []
+        since = None
+        settled = False
+
+        while True:
+            value = self.read()
+            now = self.clock()
+            if value is not None and (condition is None or condition(value)):
+                samples.append((now, value))
+                while now - samples[0][0] > window:
+                    del samples[0]
+                since = now if since is None else since
+                if now - since >= window and is_steady(samples, self.tolerance, self.min_tolerance):
+                    settled = True
+                    break
+            else:
+                # the condition has to hold for the whole window
+                samples = []
+                since = None
+
+            if now - start >= timeout:
+                break
+            if p and now >= next_print:
+                print("#", end="", flush=True, file=out)
+                next_print += 1
+            self.sleep(self.interval)
+
+        self.__set_result(samples, settled)
+        elapsed = self.clock() - start
+        self.spent += elapsed
+        if budget is not None:
+            self.saved += budget - elapsed
+        if p:
+            print("#", end="", flush=True, file=out)
+        return settled
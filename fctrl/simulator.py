@@ -0,0 +1,342 @@
+# coding=utf-8
+"""simulated hwmon tree for running the daemon and the detection off real hardware
+
+the simulator writes a hwmon class directory (hwmonN/name, tempN_input, tempN_label, pwmN, pwmN_enable,
+fanN_input, device/vendor) to a temporary directory and keeps it up to date from a thermal model:
+
+fans     follow their pwm with a first order lag (tau seconds) between min-rpm (at stop-pwm) and max-rpm (at 255).
+         a standing fan starts at start-pwm and a running one stops below stop-pwm (hysteresis), pumps (stop-pwm
+         0) never stop. while pwmN_enable is not 1 the chip drives pwmN to auto-pwm itself.
+sensors  are RC nodes: capacity * dT/dt = power - (conductance + sum of fan-conductance * rpm / max-rpm of the
+         fans cooling them) * (T - ambient). power is W or cyclic [[seconds, W], ...] steps.
+
+the model runs on a VirtualClock, speed times faster than wall time. installing the simulator points
+hwmon.HWMON_BASE at the tree and replaces monotonic and sleep of the modules in CLOCK_MODULES, so the detection
+and an Engine from create_engine run at simulated speed."""
+import importlib
+import json
+import math
+import os
+import random
+import shutil
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+# modules importing monotonic or sleep from time, patched while a simulator is installed
+CLOCK_MODULES = ("sampler", "watchdog", "file_ops", "settle", "characterization", "cli", "detection_dialog",
+                 "cooling_manager", "thermal_manager", "fctrl", "telemetry")
+FIELD_WIDTH = 16
+
+
+def default_chips():
+    """returns chips of a desktop with a package + 4 core cpu, an aio pump, two case fans and a gpu"""
+    load = [[300, 12], [120, 80], [300, 35], [60, 95]]
+    cooled = {"nct6791/pwm1": 0.9, "nct6791/pwm2": 0.5, "nct6791/pwm3": 0.9}
+    cpu = [{"label": "Physical id 0", "power": load, "capacity": 60, "conductance": 0.35, "fans": cooled}]
+    cpu += [{"label": "Core " + str(i), "power": [[t, w * (0.9 - 0.03 * i)] for t, w in load], "capacity": 60,
+             "conductance": 0.35, "fans": cooled} for i in range(4)]
+    board = {"power": 3, "capacity": 400, "conductance": 0.15, "fans": {"nct6791/pwm1": 0.1, "nct6791/pwm3": 0.1}}
+    return [
+        {"name": "acpitz", "sensors": [dict(board), dict(board, power=4)]},
+        {"name": "coretemp", "sensors": cpu},
+        {"name": "nct6791",
+         "sensors": [dict(board, label="SYSTIN"), dict(board, label="CPUTIN", power=5),
+                     dict(board, label="AUXTIN2", power=2), dict(cpu[0], label="PECI Agent 0")],
+         "fans": [{"index": 1, "max-rpm": 2100, "min-rpm": 600, "start-pwm": 80, "stop-pwm": 60},
+                  {"index": 2, "max-rpm": 4485, "min-rpm": 1260, "start-pwm": 0, "stop-pwm": 0, "tau": 2},
+                  {"index": 3, "max-rpm": 2200, "min-rpm": 610, "start-pwm": 82, "stop-pwm": 62}]},
+        {"name": "nouveau", "vendor": "0x10de",
+         "sensors": [{"power": [[200, 15], [200, 50]], "capacity": 80, "conductance": 0.8,
+                      "fans": {"nouveau/pwm1": 2.5}}],
+         "fans": [{"index": 1, "max-rpm": 3000, "min-rpm": 900, "start-pwm": 70, "stop-pwm": 50, "tau": 1.5}]},
+    ]
+
+
+class VirtualClock:
+    """monotonic clock running speed times faster than wall time, sleeps are shortened accordingly
+
+    listeners are called with the current time whenever the clock is read or slept on."""
+
+    def __init__(self, speed=100, start=0):
+        self.speed = speed
+        self.start = start
+        self.listeners = []
+        self.__wall = perf_counter()
+
+    def monotonic(self):
+        now = self.start + (perf_counter() - self.__wall) * self.speed
+        for listener in self.listeners:
+            listener(now)
+        return now
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            sleep(seconds / self.speed)
+        self.monotonic()
+
+
+class SimulatedFile:
+    """file of the simulated tree, the simulator writes values in place padded to a fixed width, so readers
+    holding the file open (see SysfsAttribute) never see them partially written or truncated. writes of the
+    daemon may be torn, see SimulatedFan.read_pwm"""
+
+    def __init__(self, path, value):
+        with open(path, "w") as file:
+            file.write(str(value))
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CLOEXEC)
+
+    def read_int(self):
+        try:
+            return int(os.pread(self.fd, FIELD_WIDTH, 0))
+        except ValueError:
+            return None
+
+    def read_text(self):
+        return os.pread(self.fd, FIELD_WIDTH, 0).decode(errors="replace").strip()
+
+    def write(self, value):
+        os.pwrite(self.fd, str(value).ljust(FIELD_WIDTH - 1).encode() + b"\n", 0)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SimulatedFan:
+    def __init__(self, chip, data):
+        self.index = data["index"]
+        self.name = chip + "/pwm" + str(self.index)
+        self.max_rpm = data.get("max-rpm", 2000)
+        self.min_rpm = data.get("min-rpm", 600)
+        self.start_pwm = data.get("start-pwm", 80)
+        self.stop_pwm = data.get("stop-pwm", 60)
+        self.tau = data.get("tau", 1)
+        self.auto_pwm = data.get("auto-pwm", 128)
+        self.noise = data.get("rpm-noise", 0.005)
+        self.running = self.stop_pwm == 0
+        self.rpm = self.min_rpm if self.running else 0
+        self.pwm = None
+        self.enable = None
+        self.input = None
+        self.last_pwm = self.auto_pwm
+
+    def create(self, directory):
+        base = os.path.join(directory, "pwm" + str(self.index))
+        self.pwm = SimulatedFile(base, self.auto_pwm)
+        self.enable = SimulatedFile(base + "_enable", 2)
+        self.input = SimulatedFile(os.path.join(directory, "fan" + str(self.index) + "_input"), int(self.rpm))
+
+    def read_pwm(self):
+        """returns pwm written by the daemon, the last valid one while its write is torn
+
+        the daemon writes pwrite + ftruncate, a read in between sees the new digits followed by the rest of the
+        old value, e.g. "508" or "028" while "50" or "0" replaces "128". values above 255 or with a leading zero
+        are rejected. a torn value that looks valid (e.g. "200" while "2" replaces "100") is used for one
+        model step, the lag of the fan hides it."""
+        text = self.pwm.read_text()
+        if text.isdigit() and (text == "0" or not text.startswith("0")) and int(text) <= 255:
+            self.last_pwm = int(text)
+        return self.last_pwm
+
+    def get_target_rpm(self, pwm):
+        """returns rpm the fan settles at for pwm, updates the start/stop state"""
+        if not self.running and pwm >= self.start_pwm:
+            self.running = True
+        elif self.running and pwm < self.stop_pwm:
+            self.running = False
+        if not self.running:
+            return 0
+        return self.min_rpm + (self.max_rpm - self.min_rpm) * (pwm - self.stop_pwm) / (255 - self.stop_pwm)
+
+    def update(self, dt, rng):
+        if self.enable.read_int() != 1:
+            # automatic mode, the chip drives the pwm
+            pwm = self.auto_pwm
+            if self.pwm.read_int() != pwm:
+                self.pwm.write(pwm)
+        else:
+            pwm = self.read_pwm()
+
+        target = self.get_target_rpm(pwm)
+        self.rpm = target + (self.rpm - target) * math.exp(-dt / self.tau)
+        # chips report 0 for fans turning too slowly to be measured
+        rpm = self.rpm if self.rpm >= self.min_rpm / 2 else 0
+        self.input.write(int(round(rpm * (1 + rng.gauss(0, self.noise)))) if rpm else 0)
+
+    @property
+    def airflow(self):
+        """returns rpm relative to max rpm"""
+        return self.rpm / self.max_rpm
+
+
+class SimulatedSensor:
+    def __init__(self, chip, index, data):
+        self.index = index
+        self.name = chip + "/temp" + str(index)
+        self.label = data.get("label")
+        self.power = data.get("power", 5)
+        self.capacity = data.get("capacity", 100)
+        self.conductance = data.get("conductance", 0.5)
+        self.fan_conductance = data.get("fans", {})
+        self.ambient = data.get("ambient", 25)
+        self.temp = data.get("temp", self.ambient + self.get_power(0) / self.conductance / 2)
+        self.input = None
+
+    def create(self, directory):
+        base = os.path.join(directory, "temp" + str(self.index))
+        self.input = SimulatedFile(base + "_input", int(self.temp * 1000))
+        if self.label is not None:
+            with open(base + "_label", "w") as file:
+                file.write(self.label + "\n")
+
+    def get_power(self, time):
+        """returns heat load in W at time"""
+        if not isinstance(self.power, list):
+            return self.power
+        time %= sum(duration for duration, _ in self.power)
+        for duration, power in self.power:
+            if time < duration:
+                return power
+            time -= duration
+        return self.power[-1][1]
+
+    def update(self, time, dt, fans):
+        conductance = self.conductance + sum(conductance * fans[name].airflow
+                                             for name, conductance in self.fan_conductance.items() if name in fans)
+        # exact solution of the RC node for constant power and conductance over dt, stable for any step
+        target = self.ambient + self.get_power(time) / conductance
+        self.temp = target + (self.temp - target) * math.exp(-dt * conductance / self.capacity)
+        self.input.write(int(self.temp * 1000))
+
+
+class HwmonSimulator:
+    """fake hwmon class directory driven by a thermal model on a VirtualClock
+
+    chips are dicts with name, optional vendor id, sensors and fans (see module doc and default_chips). the
+    model advances in steps of at least step simulated seconds whenever the clock is read or slept on."""
+
+    def __init__(self, chips=None, speed=100, directory=None, step=0.05, seed=0):
+        self.chips = chips if chips is not None else default_chips()
+        self.clock = VirtualClock(speed)
+        self.path = directory
+        self.step = step
+        self.time = 0
+        self.fans = {}
+        self.sensors = []
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__temporary = directory is None
+        self.__patched = []
+        self.__telemetry_clock = None
+
+    def start(self):
+        """creates the tree and starts the model"""
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix="fctrl-hwmon-")
+        for i, chip in enumerate(self.chips):
+            directory = os.path.join(self.path, "hwmon" + str(i))
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, "name"), "w") as file:
+                file.write(chip["name"] + "\n")
+            if chip.get("vendor"):
+                os.makedirs(os.path.join(directory, "device"), exist_ok=True)
+                with open(os.path.join(directory, "device", "vendor"), "w") as file:
+                    file.write(chip["vendor"] + "\n")
+
+            for data in chip.get("fans", []):
+                fan = SimulatedFan(chip["name"], data)
+                fan.create(directory)
+                self.fans[fan.name] = fan
+            for index, data in enumerate(chip.get("sensors", []), 1):
+                sensor = SimulatedSensor(chip["name"], index, data)
+                sensor.create(directory)
+                self.sensors.append(sensor)
+
+        self.time = self.clock.monotonic()
+        self.clock.listeners.append(self.advance)
+        return self
+
+    def stop(self):
+        """stops the model, removes the tree if it was created in a temporary directory"""
+        if self.advance in self.clock.listeners:
+            self.clock.listeners.remove(self.advance)
+        for file in [f for fan in self.fans.values() for f in (fan.pwm, fan.enable, fan.input)] + \
+                [sensor.input for sensor in self.sensors]:
+            file.close()
+        if self.__temporary:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def advance(self, now):
+        """runs the model up to simulated time now"""
+        if now - self.time < self.step:
+            return
+        with self.__lock:
+            dt = now - self.time
+            if dt < self.step:
+                return
+            self.time = now
+            for fan in self.fans.values():
+                fan.update(dt, self.__rng)
+            for sensor in self.sensors:
+                sensor.update(now, dt, self.fans)
+
+    def get_state(self):
+        """returns simulated temperatures in °C and rpm by sensor and fan name"""
+        state = {sensor.name: round(sensor.temp, 2) for sensor in self.sensors}
+        state.update({name: round(fan.rpm) for name, fan in self.fans.items()})
+        return state
+
+    def install(self):
+        """points hwmon at the tree and the clock dependent modules at the simulated clock"""
+        hwmon = importlib.import_module("hwmon")
+        self.__patched.append((hwmon, "HWMON_BASE", hwmon.HWMON_BASE))
+        hwmon.HWMON_BASE = self.path
+        for name in CLOCK_MODULES:
+            module = importlib.import_module(name)
+            for attribute, func in (("monotonic", self.clock.monotonic), ("sleep", self.clock.sleep)):
+                if hasattr(module, attribute):
+                    self.__patched.append((module, attribute, getattr(module, attribute)))
+                    setattr(module, attribute, func)
+        # the shared instance took its clock when it was created
+        telemetry = importlib.import_module("telemetry").telemetry
+        self.__telemetry_clock = telemetry.clock
+        telemetry.set_clock(self.clock.monotonic)
+
+    def uninstall(self):
+        """restores everything install replaced"""
+        for module, attribute, value in reversed(self.__patched):
+            setattr(module, attribute, value)
+        self.__patched = []
+        if self.__telemetry_clock is not None:
+            importlib.import_module("telemetry").telemetry.set_clock(self.__telemetry_clock)
+            self.__telemetry_clock = None
+
+    def __enter__(self):
+        self.start()
+        self.install()
+        return self
+
+    def __exit__(self, *args):
+        self.uninstall()
+        self.stop()
+
+    def create_engine(self, control, interval=1, workers=4):
+        """returns Engine for control scheduled on the simulated clock"""
+        from engine import Engine
+        from scheduler import Scheduler
+        return Engine(control, interval, workers, Scheduler(clock=self.clock.monotonic, speed=self.clock.speed))
+
+    def run_daemon(self, control, duration, interval=1):
+        """runs control like the daemon (see FanControl.run) for duration simulated seconds, returns the Engine.
+        the config, the control socket and the flight recorder are moved into the tree"""
+        control.config_path = os.path.join(self.path, "fctrl.config")
+        control.socket_path = os.path.join(self.path, "fctrl.sock")
+        control.recorder_path = os.path.join(self.path, "flight.rec")
+        with open(control.config_path, "w") as file:
+            json.dump(control.get_json(), file)
+        engine = self.create_engine(control, interval)
+        engine.add_periodic("simulation-end", engine.stop, duration, phase=duration)
+        control.cooling_manager.set_all_to_manual()
+        control.run(engine)
+        return engine
@@ -0,0 +1,108 @@
+# coding=utf-8
+"""structured, rate limited event logging of the daemon"""
+import json
+import sys
+from time import monotonic, time
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+
+class RateLimit:
+    """token bucket allowing burst events, refilled by burst events per period seconds"""
+
+    def __init__(self, burst, period, clock=monotonic):
+        self.burst = burst
+        self.period = period
+        self.clock = clock
+        self.tokens = burst
+        self.suppressed = 0
+        self.__last = clock()
+
+    def allow(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.__last) * self.burst / self.period)
+        self.__last = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        return True
+
+
+class Telemetry:
+    """emits events as one json object per line (journald friendly)
+
+    events below level are dropped before anything is formatted, fields are kept as plain values and only
+    serialized once an event passed its rate limit. callers building expensive fields check enabled first.
+    every event name has its own rate limit (rate-limits, else default-rate-limit as [burst, period]), the
+    number of events suppressed in between is attached to the next emitted one."""
+
+    def __init__(self, data=None, stream=None, clock=monotonic):
+        self.stream = stream
+        self.clock = clock
+        self.sinks = []
+        self.emitted = 0
+        self.configure(data)
+
+    def configure(self, data=None):
+        """sets level and rate limits, may be called on a running instance. an unknown level keeps the previous
+        one (info initially) and emits a warning"""
+        data = data if data is not None else {}
+        level = data.get("level", "info")
+        invalid = level not in LEVELS
+        if invalid:
+            level = getattr(self, "level", "info")
+        self.level = level
+        self.threshold = LEVELS[self.level]
+        self.rate_limits = data.get("rate-limits", {})
+        self.default_rate_limit = data.get("default-rate-limit", [10, 60])
+        self.__limits = {}
+        if invalid:
+            self.event("invalid-level", "warning", value=data["level"], kept=self.level, expected=list(LEVELS))
+
+    def set_clock(self, clock):
+        """sets the clock of the rate limits, they restart on it"""
+        self.clock = clock
+        self.__limits = {}
+
+    def get_json(self):
+        """return data as dict for json"""
+        return {"level": self.level, "rate-limits": self.rate_limits, "default-rate-limit": self.default_rate_limit}
+
+    def add_sink(self, sink):
+        """registers sink(event dict) receiving every emitted event"""
+        self.sinks.append(sink)
+
+    def enabled(self, level):
+        """returns whether events of level are emitted"""
+        return LEVELS[level] >= self.threshold
+
+    def event(self, name, level="info", **fields):
+        """emits event name with fields, returns whether it was emitted"""
+        if LEVELS[level] < self.threshold:
+            return False
+
+        limit = self.__limits.get(name)
+        if limit is None:
+            burst, period = self.rate_limits.get(name, self.default_rate_limit)
+            limit = self.__limits[name] = RateLimit(burst, period, self.clock)
+        if not limit.allow():
+            return False
+
+        event = {"event": name, "level": level, "time": time()}
+        event.update(fields)
+        if limit.suppressed:
+            event["suppressed"] = limit.suppressed
+            limit.suppressed = 0
+        self.emitted += 1
+
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(json.dumps(event, default=str) + "\n")
+        stream.flush()
+        for sink in self.sinks:
+            sink(event)
+        return True
+
+
+# shared by all modules, configured from the "telemetry" config key
+telemetry = Telemetry()
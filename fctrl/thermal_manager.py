@@ -3,15 +3,18 @@
 import os
 from time import sleep
 from thermal_zone import ThermalZone, load_thermal_zone
-from cli import print_table
+from sampler import Sampler
+from registry import Registry
 import pprint
 
 
 class ThermalManager:
     """manages all ThermalZones"""
 
-    def __init__(self, data):
+    def __init__(self, data, sampler=None):
+        self.sampler = sampler if sampler is not None else Sampler()
         self.thermal_zones = []
+        self.__zones = Registry(lambda: self.thermal_zones, lambda zone: zone.full_name)
         self.load_thermal_zones(data)
 
     def get_json(self):
@@ -27,6 +30,32 @@ class ThermalManager:
         for zone in data["zones"]:
             self.thermal_zones.append(load_thermal_zone(self, zone))
 
+    def prepare_json(self, data):
+        """loads data (see get_json) without touching the live zones, raises if data is invalid
+
+        returns the new zone list and a function swapping it in. zones that only changed thresholds or filters
+        are kept and updated in place by that function, all others are loaded anew"""
+        zones = []
+        updates = []
+        for zone_data in data["zones"]:
+            # loaded even if the live zone is kept, so invalid thresholds or filters fail here
+            zone = load_thermal_zone(self, zone_data)
+            live = self.get_zone(full_name=zone.full_name)
+            if live is not None and live.accepts_json(zone_data):
+                updates.append((live, zone_data))
+                zone = live
+            zones.append(zone)
+
+        def commit():
+            for live, zone_data in updates:
+                live.apply_json(zone_data)
+            self.thermal_zones = zones
+        return zones, commit
+
+    def apply_json(self, data):
+        """applies data (see get_json) to the live zones, see prepare_json"""
+        self.prepare_json(data)[1]()
+
     def get_all_temps(self, as_dict=False):
         """returns list of temps of all thermal_zones"""
         if as_dict:
@@ -42,10 +71,7 @@ class ThermalManager:
     def get_zone(self, index=None, full_name=None):
         """returns thermal_zone described in query, None if unavailable"""
         if full_name is not None:
-            try:
-                return [zone for zone in self.thermal_zones if zone.full_name == full_name][0]
-            except IndexError:
-                return None
+            return self.__zones.get(full_name)
 
         if index is not None and index >= 0:
             return self.thermal_zones[index]
@@ -1,4 +1,9 @@
 from file_ops import *
+from filters import FilterChain
+from curves import ScoreTable
+
+# keys of a zone that can be changed on a live zone, see ThermalZone.apply_json
+LIVE_KEYS = ("idle", "desired", "critical", "filters")
 
 
 def load_thermal_zone(mng, data):
@@ -8,6 +13,9 @@ def load_thermal_zone(mng, data):
         return ThermalGpu(mng, data)
     elif data["class"] == "ThermalCpu":
         return ThermalCpu(mng, data)
+    elif data["class"] == "ThermalComposite":
+        return ThermalComposite(mng, data)
+    raise ValueError("unknown thermal zone class " + str(data["class"]))
 
 
 class ThermalZone:
@@ -16,23 +24,32 @@ class ThermalZone:
     def __init__(self, mng, data=None):
         self.mng = mng
         self.__base_path = ""
+        self.__input = None
         self.hwmon_name = ""
         self.hwmon = None
         self.name = "None"
-        self.critical = 80
-        self.desired = 60
-        self.idle = 50
+        self.__critical = 80
+        self.__desired = 60
+        self.__idle = 50
+        self.__score_table = ScoreTable(self.__idle, self.__desired, self.__critical)
+        self.filters = None
+        self.__filtered = None
+        self.__filtered_tick = None
 
         if data is not None:
-            self.__base_path = data["base-path"]
+            self.__set_base_path(data["base-path"])
             self.name = data["name"]
             self.hwmon_name = data["hwmon"]
-            self.critical = data.get("critical")
-            self.desired = data.get("desired")
-            self.idle = data.get("idle")
+            self.set_thresholds(data.get("idle"), data.get("desired"), data.get("critical"))
+            if data.get("filters"):
+                self.filters = FilterChain(data["filters"])
 
-    def from_hwmon(self, base_path, hwmon):
+    def __set_base_path(self, base_path):
         self.__base_path = base_path
+        self.__input = get_attribute(base_path + "_input") if base_path else None
+
+    def from_hwmon(self, base_path, hwmon):
+        self.__set_base_path(base_path)
         self.hwmon_name = hwmon.name
         self.hwmon = hwmon
 
@@ -44,14 +61,74 @@ class ThermalZone:
 
     def get_json(self):
         """return data as dict for json"""
-        return {"name": self.name, "hwmon": self.hwmon_name,
+        data = {"name": self.name, "hwmon": self.hwmon_name,
                 "base-path": self.__base_path, "class": self.__class__.__name__,
                 "critical": self.critical, "desired": self.desired, "idle": self.idle}
+        if self.filters is not None:
+            data["filters"] = self.filters.get_json()
+        return data
+
+    def accepts_json(self, data):
+        """returns whether data describes this zone, i.e. differs in LIVE_KEYS only"""
+        current = self.get_json()
+        return all(current.get(key) == value for key, value in data.items() if key not in LIVE_KEYS)
+
+    def apply_json(self, data):
+        """applies thresholds and filters of data in place, returns False if data describes a different zone"""
+        if not self.accepts_json(data):
+            return False
+
+        current = self.get_json()
+        self.set_thresholds(data.get("idle"), data.get("desired"), data.get("critical"))
+        if data.get("filters") != current.get("filters"):
+            self.filters = FilterChain(data["filters"]) if data.get("filters") else None
+            self.__filtered = None
+            self.__filtered_tick = None
+        return True
 
     @property
     def base_path(self):
         return self.__base_path
 
+    @property
+    def input_paths(self):
+        """returns paths of the attributes the temperature is read from"""
+        return [self.__base_path + "_input"] if self.__base_path else []
+
+    @property
+    def idle(self):
+        return self.__idle
+
+    @idle.setter
+    def idle(self, value):
+        self.set_thresholds(idle=value)
+
+    @property
+    def desired(self):
+        return self.__desired
+
+    @desired.setter
+    def desired(self, value):
+        self.set_thresholds(desired=value)
+
+    @property
+    def critical(self):
+        return self.__critical
+
+    @critical.setter
+    def critical(self, value):
+        self.set_thresholds(critical=value)
+
+    def set_thresholds(self, idle=None, desired=None, critical=None):
+        """sets given thresholds in °C and swaps in a newly compiled score table"""
+        if idle is not None:
+            self.__idle = idle
+        if desired is not None:
+            self.__desired = desired
+        if critical is not None:
+            self.__critical = critical
+        self.__score_table = ScoreTable(self.__idle, self.__desired, self.__critical)
+
     @property
     def temp(self):
         """returns current temparture of thermal zone in °C"""
@@ -69,28 +146,37 @@ class ThermalZone:
         return self.hwmon_name + "/" + self.name
 
     def get_temp(self):
-        """returns current temparture of thermal zone in °C"""
-        content = read_all(self.__base_path + "_input")
-        try:
-            temp = int(content)
-        except (ValueError, TypeError):
+        """returns current temparture of thermal zone in °C (millidegree precision)"""
+        temp = self.get_temp_milli()
+        if temp is None:
             return None
+        return temp / 1000
 
-        return temp//1000
+    def get_temp_milli(self):
+        """returns current filtered temparture of thermal zone in m°C
+
+        the filter chain advances once per sampler tick, live reads outside the daemon are not filtered"""
+        snapshot = self.mng.sampler.snapshot
+        if self.filters is None or snapshot is None:
+            return self._read_temp_milli()
+
+        if self.__filtered_tick != snapshot.tick:
+            temp = self._read_temp_milli()
+            self.__filtered = None if temp is None else self.filters.update(temp, self.mng.sampler.get_time_scale())
+            self.__filtered_tick = snapshot.tick
+        return self.__filtered
+
+    def _read_temp_milli(self):
+        """returns raw temparture reading in m°C"""
+        if self.__input is None:
+            return None
+        return self.mng.sampler.read_int(self.__input)
 
     def seems_legit(self):
         return 10 < self.temp < 95
 
     def _get_score(self):
-        temp = self.temp
-        if temp < self.idle:
-            return 0 + temp/self.idle
-        elif temp < self.desired:
-            return 1 + (temp-self.idle)/(self.desired - self.idle)
-        elif temp < self.critical:
-            return 2 + (temp-self.desired)/(self.critical - self.desired)
-        elif temp >= self.critical:
-            return 3
+        return self.__score_table(self.temp)
 
     def get_score(self):
         return round(self._get_score(), 1)
@@ -104,41 +190,138 @@ class ThermalGpu(ThermalZone):
         return self
 
 
-class ThermalCpu(ThermalZone):
+def reduce_top_k(values, k=2, **_):
+    """mean of the k highest values"""
+    top = sorted(values, reverse=True)[:max(int(k), 1)]
+    return sum(top) / len(top)
+
+
+def reduce_percentile(values, percentile=90, **_):
+    """percentile of values, linearly interpolated"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * min(max(percentile, 0), 100) / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+REDUCERS = {
+    "max": lambda values, **_: max(values),
+    "mean": lambda values, **_: sum(values) / len(values),
+    "top-k": reduce_top_k,
+    "percentile": reduce_percentile,
+}
+
+
+class ThermalComposite(ThermalZone):
+    """thermal zone aggregating the readings of member zones (paths without _input) with a reducer
+
+    reducers: max, mean, top-k (mean of the k hottest, option "k") and percentile (option "percentile")"""
+
+    default_name = "composite"
+
     def __init__(self, mng, data=None):
         super().__init__(mng, data)
-        self.name = "CPU"
         self.hwmon_name = ""
         self.__zones = []
+        self.__inputs = []
+        self.reducer = "max"
+        self.reducer_options = {}
+
+        if data is None or not data.get("name"):
+            self.name = self.default_name
+        if data is not None:
+            self.set_reducer(data.get("reducer", "max"), data.get("reducer-options", {}))
+            if "zones" in data:
+                self.__set_zones(data["zones"])
+
+    def set_reducer(self, reducer, options=None):
+        """sets reducer by name with its options, raises ValueError if either is invalid"""
+        options = options if options is not None else {}
+        if reducer not in REDUCERS:
+            raise ValueError("unknown reducer {!r}, expected one of {}".format(reducer, ", ".join(REDUCERS)))
+        if not isinstance(options, dict):
+            raise ValueError("reducer-options have to be an object")
+        try:
+            # options of the wrong type (e.g. "k": "two") would fail every tick
+            REDUCERS[reducer]([0], **options)
+        except (TypeError, ValueError) as e:
+            raise ValueError("invalid reducer-options for {}: {}".format(reducer, e))
+        self.reducer = reducer
+        self.reducer_options = options
+
+    def __set_zones(self, zones):
+        self.__zones = zones
+        self.__inputs = [get_attribute(zone + "_input") for zone in zones]
+
+    @property
+    def zones(self):
+        """returns paths of member zones"""
+        return self.__zones
+
+    @property
+    def input_paths(self):
+        """returns paths of the attributes the temperature is read from"""
+        return [attribute.path for attribute in self.__inputs]
 
-        if data is not None and "zones" in data:
-            self.__zones = data["zones"]
+    def set_members(self, zones):
+        """sets member zones from ThermalZone objects"""
+        self.__set_zones([zone.base_path for zone in zones])
+        return self
 
     def from_hwmon(self, base_path, hwmon):
         super().from_hwmon("", hwmon)
-        self.name = "CPU"
+        self.name = self.default_name
         self.hwmon_name = ""
-        self.__zones = [zone.base_path for zone in hwmon.thermal_zones]
-        return self
+        return self.set_members(hwmon.thermal_zones)
 
     def get_json(self):
         """return data as dict for json"""
         data = super().get_json()
         data["zones"] = self.__zones
+        data["reducer"] = self.reducer
+        data["reducer-options"] = self.reducer_options
         return data
 
-    def get_temp(self):
-        """returns current temparture of thermal zone in °C"""
-        max_temp = 0
-        for zone in self.__zones:
-            content = read_all(zone + "_input")
-            try:
-                temp = int(content)
-            except (ValueError, TypeError):
-                continue
-
-            max_temp = max(max_temp, temp // 1000)
+    def _read_temp_milli(self):
+        """returns reduced temparture reading of all members in m°C"""
+        sampler = self.mng.sampler
+        values = [temp for temp in (sampler.read_int(attribute) for attribute in self.__inputs) if temp is not None]
+        if not values:
+            return None
 
-        if max_temp == 0:
+        temp = REDUCERS[self.reducer](values, **self.reducer_options)
+        if temp < 1000:
             return None
-        return max_temp
+        return temp
+
+
+class ThermalCpu(ThermalComposite):
+    """composite of all sensors of one cpu package (one coretemp hwmon per physical package)"""
+
+    default_name = "CPU"
+
+
+def get_package_id(hwmon):
+    """returns physical package id of a coretemp hwmon, None if unknown"""
+    for zone in hwmon.thermal_zones:
+        for prefix in ("Package id ", "Physical id "):
+            if zone.name.startswith(prefix):
+                try:
+                    return int(zone.name[len(prefix):])
+                except ValueError:
+                    return None
+    return None
+
+
+def group_cpu_packages(mng, hwmons):
+    """returns one ThermalCpu per physical cpu package, named CPU (single socket) or CPU<package id>"""
+    cpu_hwmons = [hwmon for hwmon in hwmons if hwmon.type == "CPU" and len(hwmon.thermal_zones) > 0]
+    result = []
+    for i, hwmon in enumerate(cpu_hwmons):
+        cpu = ThermalCpu(mng).from_hwmon("", hwmon)
+        if len(cpu_hwmons) > 1:
+            package_id = get_package_id(hwmon)
+            cpu.name = "CPU" + str(package_id if package_id is not None else i)
+        result.append(cpu)
+    return result
@@ -0,0 +1,121 @@
+# coding=utf-8
+"""struct of arrays controller for dense systems, requires numpy"""
+import numpy as np
+from filters import scale_alpha
+from telemetry import telemetry
+
+
+class VectorController:
+    """computes all duty mode devices of a CoolingManager in a few numpy operations per tick
+
+    build up, responsiveness, thresholds and zone membership of every device are kept in arrays, every zone
+    score is evaluated once per tick and the fan curves are stacked into one table. results and device state
+    match CoolingDevice.compute_speed, the per device debug line is not printed. devices in rpm control mode
+    are left to CoolingDevice.compute_speed."""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.devices = []
+        self.zones = []
+        self.__signature = None
+
+    def get_signature(self):
+        """returns tuple describing the current layout, changes when devices, zones or curves change"""
+        return tuple((device, device.rpm_control_active, device.curve, device.threshold_speed,
+                      device.build_up_thresholds, tuple(device.thermal_zones))
+                     for device in self.manager.cooling_devices)
+
+    def rebuild(self, signature=None):
+        """rebuilds all arrays from the devices"""
+        self.__signature = signature if signature is not None else self.get_signature()
+        self.devices = [device for device in self.manager.cooling_devices if not device.rpm_control_active]
+
+        zone_index = {}
+        for device in self.devices:
+            for zone in device.thermal_zones:
+                zone_index.setdefault(zone, len(zone_index))
+        self.zones = list(zone_index)
+
+        # membership matrix padded with an index pointing at a constant score of 0
+        width = max([len(device.thermal_zones) for device in self.devices] + [1])
+        self.members = np.full((len(self.devices), width), len(self.zones), dtype=np.intp)
+        for i, device in enumerate(self.devices):
+            for j, zone in enumerate(device.thermal_zones):
+                self.members[i, j] = zone_index[zone]
+
+        states = [device.get_state() for device in self.devices]
+        self.build_up = np.array([state["build-up"] for state in states], dtype=float)
+        self.responsiveness = np.array([state["responsiveness"] for state in states], dtype=float)
+        self.thresh_idle = np.array([device.build_up_thresholds[0] for device in self.devices], dtype=float)
+        self.thresh_desired = np.array([device.build_up_thresholds[1] for device in self.devices], dtype=float)
+        self.threshold_speed = np.array([device.threshold_speed for device in self.devices], dtype=float)
+
+        tables = [device.curve.table for device in self.devices]
+        self.curve_start = tables[0].start if tables else 0
+        self.curve_step = tables[0].step if tables else 1
+        self.curves = np.array([table.table for table in tables], dtype=float).reshape(len(tables), -1)
+
+    def update_responsiveness(self, responsive, scale=1):
+        responsiveness = np.clip(self.responsiveness + np.where(responsive, scale, -scale), -15, 15)
+        unresponsive = responsiveness <= 0
+        for i in np.flatnonzero(unresponsive):
+            telemetry.event("not-responsive", "warning", device=self.devices[i].full_name)
+            self.devices[i].set_to_manual()
+        responsiveness[unresponsive] = 10
+        self.responsiveness = responsiveness
+
+    def evaluate_curves(self, score):
+        position = np.clip((score - self.curve_start) / self.curve_step, 0, self.curves.shape[1] - 1)
+        index = np.minimum(position.astype(np.intp), self.curves.shape[1] - 2)
+        rows = np.arange(len(self.devices))
+        low = self.curves[rows, index]
+        return low + (self.curves[rows, index + 1] - low) * (position - index)
+
+    def compute_speeds(self, responsive):
+        """runs the control step, responsive maps devices to bools (see CoolingManager.check_responsiveness).
+        returns speeds in % in the order of self.devices"""
+        signature = self.get_signature()
+        if signature != self.__signature:
+            self.rebuild(signature)
+        if not self.devices:
+            return []
+
+        scale = self.manager.sampler.get_time_scale()
+        self.update_responsiveness(np.array([responsive[device] for device in self.devices], dtype=bool), scale)
+
+        scores = np.fromiter((zone.score for zone in self.zones), dtype=float, count=len(self.zones))
+        score = np.append(scores, 0)[self.members].max(axis=1)
+
+        build_up, idle, desired = self.build_up, self.thresh_idle, self.thresh_desired
+        result = build_up.copy()
+        # under idle
+        result[score < 1] = 0
+        # over idle but under desired
+        between = (score >= 1) & (score < 2)
+        rising = between & (build_up < idle)
+        falling_fast = between & ~rising & (build_up > idle + 100)
+        falling = between & ~rising & ~falling_fast & (build_up > idle + 10)
+        result += np.where(rising, 10 * (score - 1) * scale, 0)
+        result -= np.where(falling_fast, 100 * (1 - (score - 1)) * scale, 0)
+        result -= np.where(falling, 10 * (1 - (score - 1)) * scale, 0)
+        # over desired but under critical
+        over = (score >= 2) & (score < 3)
+        result += np.where(over & (build_up < desired * 1.2), 100 * (score - 2) * scale, 0)
+        result = np.where(over & (score >= 2.7), desired, result)
+        # smoke prevention
+        for i in np.flatnonzero(score >= 3):
+            self.devices[i].respond_to_crititcal()
+        self.build_up = result
+
+        started = result > desired
+        speed = np.maximum(self.evaluate_curves(score), self.threshold_speed)
+        own_speed = np.fromiter((device.buffer_speed for device in self.devices), dtype=float,
+                                count=len(self.devices))
+        delta = speed - own_speed
+        smoothed = np.where((delta <= 15) & (np.abs(delta) > 3), own_speed + delta * scale_alpha(0.3, scale), speed)
+        speeds = np.where(started, smoothed, 0)
+
+        for i, device in enumerate(self.devices):
+            device.set_state({"started": bool(started[i]), "build-up": float(result[i]),
+                              "responsiveness": float(self.responsiveness[i])})
+        return speeds.tolist()
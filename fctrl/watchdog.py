@@ -0,0 +1,103 @@
+# coding=utf-8
+"""fan stall and tachometer failure watchdog"""
+from collections import deque
+from time import monotonic, time
+
+
+class StallWatchdog:
+    """compares every fans rpm against the rpm expected by its fan model each tick
+
+    a fan commanded above its threshold speed (and out of spin up) reading less than ratio * expected rpm
+    (or no rpm at all) is stalled. while a fan is stalled all other fans sharing one of its thermal zones are
+    raised to compensation_speed in the same tick. alarms are dicts passed to every listener. times are snapshot
+    times (see Sampler), the compensation latency runs from the first snapshot reading the stalled rpm (e.g. still
+    in spin up) to the snapshot compensating it."""
+
+    def __init__(self, ratio=0.3, spin_up=3, compensation_speed=100, max_alarms=100):
+        self.ratio = ratio
+        self.spin_up = spin_up
+        self.compensation_speed = compensation_speed
+        self.stalled = {}
+        self.alarms = deque(maxlen=max_alarms)
+        self.listeners = []
+        self.latencies = deque(maxlen=max_alarms)
+        self.__running_since = {}
+        self.__low_since = {}
+        self.__uncompensated = []
+
+    def add_listener(self, listener):
+        """registers listener(alarm) called for every alarm"""
+        self.listeners.append(listener)
+
+    def __emit(self, event, device, **data):
+        alarm = {"event": event, "device": device.full_name, "time": time()}
+        alarm.update(data)
+        self.alarms.append(alarm)
+        for listener in self.listeners:
+            listener(alarm)
+        return alarm
+
+    def check(self, devices, now=None):
+        """checks rpm of all devices, returns list of currently stalled devices"""
+        now = monotonic() if now is None else now
+        for device in devices:
+            speed = device.buffer_speed
+            if speed < max(device.threshold_speed, 1) or len(device.fan_model) == 0:
+                self.__running_since.pop(device, None)
+                self.__low_since.pop(device, None)
+                self.__recover(device)
+                continue
+
+            # a fan that was just started needs some time to spin up
+            spinning_up = now - self.__running_since.setdefault(device, now) < self.spin_up
+            expected = device.fan_model.rpm(speed)
+            rpm = device.rpm
+            if not expected or (rpm is not None and rpm >= self.ratio * expected):
+                self.__low_since.pop(device, None)
+                if not spinning_up:
+                    self.__recover(device, rpm)
+                continue
+
+            low_since = self.__low_since.setdefault(device, now)
+            if not spinning_up and device not in self.stalled:
+                self.stalled[device] = self.__emit("fan-stall", device, rpm=rpm, expected_rpm=round(expected),
+                                                   speed=round(speed, 1))
+                self.__uncompensated.append((device, low_since))
+        return list(self.stalled)
+
+    def __recover(self, device, rpm=None):
+        if self.stalled.pop(device, None) is not None:
+            self.__emit("fan-recovered", device, rpm=rpm)
+
+    def forget(self, device):
+        """drops all state of a removed device"""
+        self.stalled.pop(device, None)
+        self.__running_since.pop(device, None)
+        self.__low_since.pop(device, None)
+        self.__uncompensated = [(d, detected) for d, detected in self.__uncompensated if d is not device]
+
+    def compensate(self, speeds, now=None):
+        """returns (device, speed) pairs with fans sharing a zone with a stalled fan raised, now is the time of
+        the snapshot the speeds were computed for"""
+        if not self.stalled:
+            return speeds
+
+        zones = set(zone for device in self.stalled for zone in device.thermal_zones)
+        result = []
+        for device, speed in speeds:
+            if device not in self.stalled and any(zone in zones for zone in device.thermal_zones):
+                speed = max(speed, self.compensation_speed)
+            result.append((device, speed))
+
+        compensated = monotonic() if now is None else now
+        for device, detected in self.__uncompensated:
+            self.latencies.append(compensated - detected)
+            self.stalled[device]["compensation_latency"] = compensated - detected
+        self.__uncompensated = []
+        return result
+
+    def get_stats(self):
+        """returns stalled fans and stall to compensation latencies in seconds"""
+        return {"stalled": [device.full_name for device in self.stalled],
+                "last_latency": self.latencies[-1] if self.latencies else None,
+                "max_latency": max(self.latencies) if self.latencies else None}
@@ -0,0 +1,83 @@
+# coding=utf-8
+import io
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "fctrl"))
+
+import telemetry as telemetry_module
+from telemetry import Telemetry, telemetry
+from simulator import HwmonSimulator
+
+CHIPS = [{"name": "nct6791",
+          "sensors": [{"label": "CPUTIN", "power": 40, "capacity": 100, "conductance": 0.5, "temp": 62,
+                       "fans": {"nct6791/pwm1": 1.5}}],
+          "fans": [{"index": 1, "max-rpm": 2000, "min-rpm": 600, "start-pwm": 80, "stop-pwm": 60,
+                    "rpm-noise": 0}]}]
+
+
+class FailingStream(io.StringIO):
+    def write(self, text):
+        raise AssertionError("unexpected output " + repr(text))
+
+    def flush(self):
+        raise AssertionError("unexpected flush")
+
+
+class TelemetryTest(unittest.TestCase):
+    def test_invalid_level_keeps_previous(self):
+        stream = io.StringIO()
+        events = Telemetry({"level": "warning"}, stream=stream)
+        events.configure({"level": "verbose"})
+        self.assertEqual(events.level, "warning")
+        self.assertIn('"invalid-level"', stream.getvalue())
+
+    def test_dropped_events_are_not_formatted(self):
+        events = Telemetry({"level": "warning"}, stream=FailingStream())
+        with mock.patch.object(telemetry_module.json, "dumps", side_effect=AssertionError("formatted")):
+            self.assertFalse(events.event("device-tick", "debug", speed=40))
+            self.assertFalse(events.event("speed-peak", "info", speed=40))
+        self.assertEqual(events.emitted, 0)
+
+    def test_steady_state_tick_is_silent(self):
+        previous = telemetry.get_json()
+        with HwmonSimulator(CHIPS, speed=1000) as sim:
+            from fctrl import FanControl
+            from hwmon import get_all_hwmons
+            control = FanControl({"cooling": {"devices": []}, "thermal": {"zones": []},
+                                  "telemetry": {"level": "info"}})
+            try:
+                hwmon = get_all_hwmons(control)[0]
+                zone, device = hwmon.thermal_zones[0], hwmon.cooling_devices[0]
+                # running fans stop below pwm 60 (23.5%)
+                device.rpm_curve = [0] * 3 + [int(round(600 + 1400 * (25.5 * i - 60) / 195)) for i in range(3, 11)]
+                device.threshold_speed = 35
+                device.thermal_zones = [zone]
+                control.thermal_manager.thermal_zones = [zone]
+                control.cooling_manager.cooling_devices = [device]
+                device.set_to_manual()
+
+                def tick():
+                    sim.clock.sleep(1)
+                    control.sampler.sample()
+                    control.cooling_manager.update_devices()
+
+                with mock.patch("sys.stdout", new=io.StringIO()):
+                    for _ in range(600):
+                        tick()
+                self.assertGreater(device.buffer_speed, 0)
+
+                emitted = telemetry.emitted
+                with mock.patch("sys.stdout", new=FailingStream()), \
+                        mock.patch.object(telemetry_module.json, "dumps", side_effect=AssertionError("formatted")):
+                    for _ in range(100):
+                        tick()
+                self.assertEqual(telemetry.emitted, emitted)
+            finally:
+                telemetry.configure(previous)
+
+
+if __name__ == "__main__":
+    unittest.main()